@@ -1,8 +1,7 @@
 from __future__ import annotations
 
 import logging
-from contextlib import nullcontext
-from functools import partial
+import sys
 from pathlib import Path
 
 from utils_python import (
@@ -10,58 +9,107 @@ from utils_python import (
     read_list_from_file,
     setup_config_logging,
     setup_excepthook,
-    write_at_exit,
 )
 
-from genreliser.args import get_args
+from genreliser.acoustid_ import configure_fingerprint_store
+from genreliser.args import get_args, get_index_wiki_args
+from genreliser.cache import configure_response_cache
+from genreliser.fandom_ import WikiClient
 from genreliser.monstercat import MonstercatGenreliser
+from genreliser.store import RETRIED_STATUSES, ResultStore
+from genreliser.wiki_index import (
+    WikiIndex,
+    build_wiki_index,
+    refresh_wiki_index,
+)
 
 LOGGER = logging.getLogger("genreliser")
 
 
+def index_wiki(argv: list[str]):
+    args = get_index_wiki_args(argv)
+    setup_config_logging(args.logging_config_path)
+    setup_excepthook(LOGGER, "received KeyboardInterrupt; exiting.")
+    configure_response_cache(None if args.no_cache else args.cache_dir)
+
+    wiki_index = WikiIndex(args.wiki_index_path)
+    client = WikiClient(args.wiki, args.language)
+    if args.refresh:
+        refresh_wiki_index(wiki_index, client)
+    else:
+        build_wiki_index(wiki_index, client, dump_path=args.dump_path)
+
+
 def main():
+    if sys.argv[1:2] == ["index-wiki"]:
+        return index_wiki(sys.argv[2:])
+
     args = get_args()
     setup_config_logging(args.logging_config_path)
     setup_excepthook(LOGGER, "received KeyboardInterrupt; exiting.")
+    configure_response_cache(None if args.no_cache else args.cache_dir)
+    configure_fingerprint_store(None if args.no_cache else args.fingerprints_path)
 
-    previous_failed_files = read_list_from_file(args.failed_files_path, element_fn=Path)
-    LOGGER.info(
-        "found %s previous_failed_files from '%s'",
-        len(previous_failed_files),
-        args.failed_files_path,
-    )
+    store = ResultStore(args.results_path, readonly=args.readonly)
+
+    previous_failed_files = []
+    if args.failed_files_path:
+        previous_failed_files = read_list_from_file(
+            args.failed_files_path, element_fn=Path
+        )
+        LOGGER.info(
+            "found %s previous_failed_files from '%s'",
+            len(previous_failed_files),
+            args.failed_files_path,
+        )
+
+    previous_json_data = {}
+    if args.json_data_path:
+        previous_json_data = read_dict_from_file(args.json_data_path, key_fn=Path)
+        LOGGER.info(
+            "found %s previous_json_data from '%s'",
+            len(previous_json_data),
+            args.json_data_path,
+        )
+
+    if previous_failed_files or previous_json_data:
+        store.import_results(previous_json_data, previous_failed_files)
 
-    previous_json_data = read_dict_from_file(args.json_data_path, key_fn=Path)
     LOGGER.info(
-        "found %s previous_json_data from '%s'",
-        len(previous_json_data),
-        args.json_data_path,
+        "found %s passed and %s failed files in '%s'",
+        store.count("passed"),
+        store.count("failed"),
+        args.results_path,
     )
 
+    paths = args.paths
+    if not paths and args.retry:
+        paths = store.get_paths(RETRIED_STATUSES[args.retry])
+        LOGGER.info("retrying %s files with retry=%s", len(paths), args.retry)
+
     genreliser = MonstercatGenreliser(
-        previous_failed_files, previous_json_data, args.retry
+        store,
+        args.retry,
+        workers=args.workers,
+        hash_files=args.hash_files,
+        fingerprint_workers=args.fingerprint_workers,
+        fetch_all_sources=args.fetch_all_sources,
     )
+    if args.wiki_index_path.exists():
+        LOGGER.info("using wiki index '%s'", args.wiki_index_path)
+        genreliser.wiki_client.index = WikiIndex(args.wiki_index_path)
 
-    if args.readonly:
-        data_ctx = failed_ctx = nullcontext
-    else:
-        data_ctx = partial(
-            write_at_exit,
-            genreliser.json_data,
-            args.json_data_path,
-            overwrite=True,
-            default_encode=str,
-        )
-        failed_ctx = partial(
-            write_at_exit,
-            genreliser.failed_files,
-            args.failed_files_path,
-            overwrite=True,
-            default_encode=str,
-        )
+    if args.refresh_wiki:
+        stale_paths = genreliser.refresh_wiki_resolutions()
+        if not paths:
+            paths = stale_paths
 
-    with data_ctx(), failed_ctx():
-        genreliser.genrelise_paths(args.paths)
+    try:
+        genreliser.genrelise_paths(paths)
+    finally:
+        if args.export_json_path:
+            store.export_json(args.export_json_path)
+            LOGGER.info("exported data to '%s'", args.export_json_path)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,43 @@
 from __future__ import annotations
 
 import logging
+import os
 import platform
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from functools import cache
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
 
 import acoustid
-from utils_python import make_get_request_to_url
 
+from genreliser.cache import (
+    cached_response,
+    get_request_key,
+    get_response_cache,
+    normalise_request_url,
+)
 from genreliser.env import ACOUSTID_API_KEY
-from genreliser.utils import restrict_filename
+from genreliser.http_ import HostUnavailableError, get_json, post_json
+from genreliser.store import normalise_path
+from genreliser.utils import connect_sqlite, hash_file, restrict_filename
 
 LOGGER = logging.getLogger("genreliser")
 
+ACOUSTID_LOOKUP_URL = "https://api.acoustid.org/v2/lookup"
+ACOUSTID_META = "recordings"
+# fingerprints per batched lookup request
+ACOUSTID_LOOKUP_BATCH_SIZE = 20
+
+DEFAULT_FINGERPRINTS_PATH = Path("data/fingerprints.sqlite")
+
+# files fingerprinted ahead of being processed, per process
+FINGERPRINTS_AHEAD_PER_WORKER = 4
+
+Fingerprint = tuple[float, str]  # (duration, fingerprint)
+
 
 class AcoustIDNotFoundError(acoustid.AcoustidError):
     ...
@@ -19,7 +45,7 @@ class AcoustIDNotFoundError(acoustid.AcoustidError):
 
 def get_fpcalc_url():
     FALLBACK_URL = "https://github.com/acoustid/chromaprint/releases/latest"
-    res = make_get_request_to_url(
+    res = get_json(
         "https://api.github.com/repos/acoustid/chromaprint/releases/latest",
         src_key="github",
     )
@@ -46,11 +72,335 @@ def ensure_fpcalc():
         pass
 
 
-def get_acoustid(filepath):
+@cache
+def get_fpcalc_version() -> str:
+    """identifies the fingerprinter, as its output can differ between versions"""
+    command = os.environ.get(acoustid.FPCALC_ENVVAR, acoustid.FPCALC_COMMAND)
+    try:
+        return subprocess.run(
+            [command, "-version"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class FingerprintStore:
+    """
+    SQLite-backed store of chromaprint fingerprints, keyed by file content hash and
+    fingerprinter version, so that each distinct audio file is only decoded once;
+    also the content hash of each file fingerprinted, while its size and mtime match
+    """
+
+    def __init__(self, path: Path = DEFAULT_FINGERPRINTS_PATH) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = connect_sqlite(self.path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                content_hash TEXT NOT NULL,
+                fpcalc_version TEXT NOT NULL,
+                duration REAL NOT NULL,
+                fingerprint TEXT NOT NULL,
+                PRIMARY KEY (content_hash, fpcalc_version)
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL
+            );
+            """
+        )
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.path}'>"
+
+    def get(self, content_hash: str) -> Optional[Fingerprint]:
+        with self.lock:
+            row = self.connection.execute(
+                """
+                SELECT duration, fingerprint FROM fingerprints
+                WHERE content_hash = ? AND fpcalc_version = ?
+                """,
+                (content_hash, get_fpcalc_version()),
+            ).fetchone()
+        return None if row is None else tuple(row)
+
+    def set(self, content_hash: str, fingerprint: Fingerprint):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                (content_hash, get_fpcalc_version(), *fingerprint),
+            )
+
+    def get_content_hash(self, filepath: Path) -> Optional[str]:
+        """the file's content hash when it was fingerprinted, if it's unchanged since"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, content_hash FROM files WHERE path = ?",
+                (normalise_path(filepath),),
+            ).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, content_hash = row
+        try:
+            stat = filepath.stat()
+        except OSError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            return None
+        return content_hash
+
+    def set_content_hash(self, filepath: Path, stat: os.stat_result, content_hash: str):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (
+                    normalise_path(filepath),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    content_hash,
+                ),
+            )
+
+
+_fingerprint_store: Optional[FingerprintStore] = None
+
+
+def configure_fingerprint_store(path: Optional[Path]) -> FingerprintStore:
+    """
+    sets the store used by `get_fingerprint`; if `path` is None, it's kept in memory
+    for this run only
+    """
+    global _fingerprint_store
+    _fingerprint_store = FingerprintStore(Path(":memory:") if path is None else path)
+    return _fingerprint_store
+
+
+def fingerprint_file(filepath: Path | str) -> Fingerprint:
+    duration, fingerprint = acoustid.fingerprint_file(str(filepath))
+    if isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.decode()
+    return duration, fingerprint
+
+
+def _init_fingerprint_worker(store_path: Optional[Path]):
+    global _fingerprint_store
     ensure_fpcalc()
-    candidates = list(acoustid.match(ACOUSTID_API_KEY, filepath))
-    LOGGER.info("candidates = %s", candidates)
+    # only read from in workers; the main process writes new fingerprints
+    _fingerprint_store = None if store_path is None else FingerprintStore(store_path)
+
+
+def _fingerprint_in_worker(
+    filepath: Path,
+) -> tuple[os.stat_result, str, Fingerprint, bool]:
+    """
+    returns the file's stat and content hash, its fingerprint, and whether that's
+    newly computed
+    """
+    stat = filepath.stat()
+    content_hash = hash_file(filepath)
+    if _fingerprint_store is not None and (
+        fingerprint := _fingerprint_store.get(content_hash)
+    ):
+        return stat, content_hash, fingerprint, False
+    return stat, content_hash, fingerprint_file(filepath), True
+
+
+def _record_fingerprints(futures: dict[Future, Path]):
+    """records fingerprints computed by `_fingerprint_in_worker`, once all are done"""
+    fingerprints = []
+    for future, filepath in futures.items():
+        try:
+            stat, content_hash, fingerprint, is_new = future.result()
+        except Exception as exc:
+            # left to be retried (and reported) when the file is processed
+            LOGGER.warning("couldn't fingerprint '%s': %s", filepath, exc)
+            continue
+        if is_new:
+            _fingerprint_store.set(content_hash, fingerprint)
+        _fingerprint_store.set_content_hash(filepath, stat, content_hash)
+        fingerprints.append(fingerprint)
+    lookup_acoustid_batch(fingerprints)
+
+
+def iter_fingerprinted_batches(
+    batches: Iterable[list[Path]], workers: Optional[int] = None
+) -> Iterator[list[Path]]:
+    """
+    Hashes, fingerprints and batch-looks up each batch of files across a pool of
+    processes, yielding each batch once it's done, so that `get_fingerprint` doesn't
+    decode audio on a single core; later batches are fingerprinted meanwhile, up to
+    FINGERPRINTS_AHEAD_PER_WORKER files per process ahead
+    """
+    ensure_fpcalc()
+    if _fingerprint_store is None:
+        configure_fingerprint_store(None)
+    # workers read already-stored fingerprints, but can't share one in memory
+    store_path = _fingerprint_store.path
+    if store_path == Path(":memory:"):
+        store_path = None
+    workers = workers or os.cpu_count()
+    max_ahead = workers * FINGERPRINTS_AHEAD_PER_WORKER
+    LOGGER.info("fingerprinting files with %s processes", workers)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_fingerprint_worker,
+        initargs=(store_path,),
+    ) as executor:
+        pending: deque[tuple[list[Path], dict[Future, Path]]] = deque()
+        pending_count = 0
+        try:
+            for filepaths in batches:
+                futures = {
+                    executor.submit(_fingerprint_in_worker, filepath): filepath
+                    for filepath in filepaths
+                }
+                pending.append((filepaths, futures))
+                pending_count += len(filepaths)
+                while pending and (
+                    pending_count > max_ahead
+                    or all(future.done() for future in pending[0][1])
+                ):
+                    filepaths, futures = pending.popleft()
+                    pending_count -= len(filepaths)
+                    _record_fingerprints(futures)
+                    yield filepaths
+            while pending:
+                filepaths, futures = pending.popleft()
+                _record_fingerprints(futures)
+                yield filepaths
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def get_fingerprinted_content_hash(filepath: Path | str) -> Optional[str]:
+    """the file's content hash, if it's been fingerprinted and is unchanged since"""
+    if _fingerprint_store is None:
+        return None
+    return _fingerprint_store.get_content_hash(Path(filepath))
+
+
+def get_fingerprint(
+    filepath: Path | str, content_hash: Optional[str] = None
+) -> Fingerprint:
+    """fingerprints the file, unless a file with the same content already has been"""
+    if _fingerprint_store is None:
+        return fingerprint_file(filepath)
+    if content_hash is None:
+        content_hash = get_fingerprinted_content_hash(filepath) or hash_file(
+            Path(filepath)
+        )
+    if (fingerprint := _fingerprint_store.get(content_hash)) is None:
+        fingerprint = fingerprint_file(filepath)
+        _fingerprint_store.set(content_hash, fingerprint)
+    else:
+        LOGGER.info("using stored fingerprint")
+    return fingerprint
+
+
+def get_lookup_params(duration: float, fingerprint: bytes | str) -> dict:
+    return {
+        "duration": int(duration),
+        "fingerprint": fingerprint,
+        "meta": ACOUSTID_META,
+    }
 
+
+# responses from `lookup_acoustid_batch`, by (duration, fingerprint), if not cached
+_batch_lookup_responses: dict[tuple[int, str], dict] = {}
+
+
+def request_lookup(params: dict) -> dict:
+    """acoustid.lookup, but rate limited and through a shared session"""
+    response = post_json(
+        ACOUSTID_LOOKUP_URL,
+        "acoustid",
+        {"format": "json", "client": ACOUSTID_API_KEY, **params},
+    )
+    if response is None:
+        raise acoustid.WebServiceError("AcoustID lookup failed")
+    return response
+
+
+def lookup_acoustid(duration: float, fingerprint: bytes | str):
+    """acoustid.lookup, with responses cached on disk"""
+    if response := _batch_lookup_responses.pop((int(duration), fingerprint), None):
+        return response
+    params = get_lookup_params(duration, fingerprint)
+    return cached_response(
+        "acoustid",
+        ACOUSTID_LOOKUP_URL,
+        params,
+        lambda: request_lookup(params),
+        should_cache=lambda response: response.get("status") == "ok",
+    )
+
+
+def lookup_acoustid_batch(
+    fingerprints: Iterable[Fingerprint],
+    batch_size: int = ACOUSTID_LOOKUP_BATCH_SIZE,
+):
+    """
+    Looks up many fingerprints with one request per `batch_size` of them, keeping
+    each one's results to be returned by `lookup_acoustid` as if looked up alone
+    """
+    response_cache = get_response_cache()
+    pending = []
+    for duration, fingerprint in dict.fromkeys(fingerprints):
+        if (
+            response_cache is not None
+            and response_cache.get(
+                "acoustid",
+                get_request_key(
+                    ACOUSTID_LOOKUP_URL, get_lookup_params(duration, fingerprint)
+                ),
+            )[0]
+        ):
+            continue
+        pending.append((duration, fingerprint))
+    if not pending:
+        return
+    LOGGER.info("looking up %s fingerprints in batches of %s", len(pending), batch_size)
+
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i : i + batch_size]
+        params = {"meta": ACOUSTID_META}
+        for n, (duration, fingerprint) in enumerate(batch):
+            params[f"duration.{n}"] = int(duration)
+            params[f"fingerprint.{n}"] = fingerprint
+        try:
+            response = request_lookup(params)
+        except (acoustid.WebServiceError, HostUnavailableError) as exc:
+            # left to be looked up individually
+            LOGGER.warning("batched AcoustID lookup failed: %s", exc)
+            continue
+        if response.get("status") != "ok":
+            LOGGER.warning("batched AcoustID lookup failed: %s", response.get("error"))
+            continue
+
+        for result in response.get("fingerprints", []):
+            duration, fingerprint = batch[int(result["index"])]
+            single_response = {"status": "ok", "results": result.get("results", [])}
+            if response_cache is None:
+                _batch_lookup_responses[(int(duration), fingerprint)] = single_response
+                continue
+            params = get_lookup_params(duration, fingerprint)
+            response_cache.set(
+                "acoustid",
+                get_request_key(ACOUSTID_LOOKUP_URL, params),
+                normalise_request_url(ACOUSTID_LOOKUP_URL, params),
+                single_response,
+            )
+
+
+def choose_acoustid_candidate(filepath, candidates: list[tuple]) -> tuple:
+    """
+    Returns the (score, acoustid, title, artist) candidate whose title and artist
+    best match the file's path, if there are several
+    """
     if len(candidates) > 1:
         LOGGER.warning(f"multiple acoustIDs for {filepath}")
         LOGGER.warning(candidates)
@@ -71,11 +421,24 @@ def get_acoustid(filepath):
             LOGGER.warning("no acoustID match!")
             raise AcoustIDNotFoundError()
             # breakpoint()
-        aid_score, res_acoustid, title, artist = ids[best_aid]
+        return ids[best_aid]
     elif len(candidates) == 1:
-        aid_score, res_acoustid, title, artist = candidates[0]
+        return candidates[0]
     else:
         raise AcoustIDNotFoundError(f"no acoustID found for {filepath}")
+
+
+def get_acoustid(filepath, content_hash: Optional[str] = None):
+    ensure_fpcalc()
+    # equivalent to acoustid.match, but with the fingerprint stored and lookup cached
+    duration, fingerprint = get_fingerprint(filepath, content_hash)
+    candidates = list(
+        acoustid.parse_lookup_result(lookup_acoustid(duration, fingerprint))
+    )
+    LOGGER.info("candidates = %s", candidates)
+    aid_score, res_acoustid, title, artist = choose_acoustid_candidate(
+        filepath, candidates
+    )
     return {"acoustid": res_acoustid, "titles": [title], "artists": artist.split("; ")}
 
 
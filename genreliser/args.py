@@ -1,27 +1,89 @@
 from __future__ import annotations
 
 import argparse
-import datetime
+import os
 from pathlib import Path
-from typing import Literal
 
 from utils_python import get_platform, read_list_from_file
 
+from genreliser.acoustid_ import DEFAULT_FINGERPRINTS_PATH
+from genreliser.cache import DEFAULT_CACHE_DIR
+from genreliser.store import DEFAULT_RESULTS_PATH, Retry
+from genreliser.tags import SUFFIX_TAG_FUNCTIONS
+from genreliser.wiki_index import DEFAULT_WIKI_INDEX_PATH
+
 
 class ArgsNamespace(argparse.Namespace):
     paths: list[Path]
     # dry_run: bool
     logging_config_path: Path
-    json_data_path: Path
-    failed_files_path: Path
-    retry: Literal["failed", "passed", "all"] | None
+    results_path: Path
+    json_data_path: Path | None
+    failed_files_path: Path | None
+    export_json_path: Path | None
+    retry: Retry | None
     readonly: bool
+    hash_files: bool
+    workers: int
+    fingerprint_workers: int
+    fetch_all_sources: bool
+    cache_dir: Path
+    no_cache: bool
+    fingerprints_path: Path
+    wiki_index_path: Path
+    refresh_wiki: bool
 
 
-def get_args():
-    now_str = datetime.datetime.now().strftime(r"%Y-%m-%dT%H-%M-%S")
+class IndexWikiArgsNamespace(argparse.Namespace):
+    logging_config_path: Path
+    cache_dir: Path
+    no_cache: bool
+    wiki_index_path: Path
+    dump_path: Path | None
+    refresh: bool
+    wiki: str
+    language: str
+
+
+def add_logging_config_path_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-l",
+        "--logging-config-path",
+        default=f"config/logging_{get_platform()}.cfg",
+        help="Path to logging config file (default: %(default)r)",
+        type=Path,
+    )
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        type=Path,
+        help="folder to cache web responses in (default: %(default)r)",
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or write cached web responses",
+    )
+
+
+def add_wiki_index_path_argument(parser: argparse.ArgumentParser, help: str):
+    parser.add_argument(
+        "-i",
+        "--wiki-index-path",
+        default=DEFAULT_WIKI_INDEX_PATH,
+        type=Path,
+        help=help,
+    )
 
-    parser = argparse.ArgumentParser()
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        epilog="see `genrelise index-wiki -h` to build an offline wiki index",
+    )
 
     parser.add_argument(
         "paths",
@@ -32,13 +94,7 @@ def get_args():
         help="path(s) to: music file(s), folder(s), or file(s) containing list of paths",
     )
 
-    parser.add_argument(
-        "-l",
-        "--logging-config-path",
-        default=f"config/logging_{get_platform()}.cfg",
-        help="Path to logging config file (default: %(default)r)",
-        type=Path,
-    )
+    add_logging_config_path_argument(parser)
 
     # parser.add_argument(
     #     "-e",
@@ -48,20 +104,32 @@ def get_args():
     #     help="update metadata in files (will dry-run if not provided)",
     # )
 
+    parser.add_argument(
+        "-s",
+        "--results-path",
+        default=DEFAULT_RESULTS_PATH,
+        type=Path,
+        help="database to record each file's results in (default: %(default)r)",
+    )
+
     parser.add_argument(
         "-j",
         "--json-data-path",
-        default=f"data/data_{now_str}.json",
         type=Path,
-        help="file to write retrieved data to (default: %(default)r)",
+        help="data_*.json file from an older version to import into the results",
     )
 
     parser.add_argument(
         "-f",
         "--failed-files-path",
-        default=f"data/failed_{now_str}.json",
         type=Path,
-        help="file to write failed paths to (default: %(default)r)",
+        help="failed_*.json file from an older version to import into the results",
+    )
+
+    parser.add_argument(
+        "--export-json-path",
+        type=Path,
+        help="file to also write all retrieved data to, as JSON, when finished",
     )
 
     parser.add_argument(
@@ -69,7 +137,8 @@ def get_args():
         "--retry",
         choices={"failed", "passed", "all"},
         type=lambda s: s.lower(),
-        help="retry some or all previous files",
+        help="retry some or all previous files"
+        " (if no FILES_OR_FOLDERS are given, retries all such files in the results)",
     )
 
     parser.add_argument(
@@ -77,10 +146,70 @@ def get_args():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--hash-files",
+        action="store_true",
+        help="record files' content hashes, and compare them to detect changes to"
+        " files whose modification time changed but size didn't",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        type=int,
+        help="number of files to process concurrently (default: %(default)r)",
+    )
+
+    parser.add_argument(
+        "--fingerprint-workers",
+        nargs="?",
+        default=0,
+        const=os.cpu_count(),
+        type=int,
+        help="fingerprint files for AcoustID across this many processes before"
+        " processing them (default: don't; if given without a number, one per CPU)",
+    )
+
+    parser.add_argument(
+        "--fetch-all-sources",
+        action="store_true",
+        help="fetch every source for each file, instead of skipping costlier ones"
+        " (e.g. the wiki) once cheaper ones (e.g. the title) have given its genres",
+    )
+
+    add_cache_arguments(parser)
+
+    parser.add_argument(
+        "--fingerprints-path",
+        default=DEFAULT_FINGERPRINTS_PATH,
+        type=Path,
+        help="file to store audio fingerprints in, by content, so unchanged files"
+        " aren't fingerprinted again (only kept in memory for the run with --no-cache)"
+        " (default: %(default)r)",
+    )
+
+    add_wiki_index_path_argument(
+        parser,
+        help="wiki index (from `genrelise index-wiki`) to look up pages in before"
+        " searching the wiki, if it exists (default: %(default)r)",
+    )
+
+    parser.add_argument(
+        "--refresh-wiki",
+        action="store_true",
+        help="before processing, check the wiki pages previously found for files for"
+        " new revisions, and process those files again if their page changed",
+    )
+
     args = parser.parse_args(namespace=ArgsNamespace())
 
     paths_new = []
     for path in args.paths:
+        if path.suffix.lower() in SUFFIX_TAG_FUNCTIONS:
+            # a music file rather than a list of paths, so don't read through it
+            paths_new.append(path)
+            continue
         if not path.is_file():
             paths_new.append(path)
         try:
@@ -90,3 +219,46 @@ def get_args():
     args.paths = paths_new
 
     return args
+
+
+def get_index_wiki_args(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="genrelise index-wiki",
+        description="build a local index of every page in a wiki's Songs category",
+    )
+
+    add_logging_config_path_argument(parser)
+
+    add_cache_arguments(parser)
+
+    add_wiki_index_path_argument(
+        parser, help="index file to create or update (default: %(default)r)"
+    )
+
+    parser.add_argument(
+        "-d",
+        "--dump-path",
+        type=Path,
+        help="MediaWiki XML dump (optionally .gz/.bz2) to index instead of crawling",
+    )
+
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="only re-index pages already in the index whose revision has changed"
+        " (and remove deleted ones), instead of crawling the whole category",
+    )
+
+    parser.add_argument(
+        "--wiki",
+        default="monstercat",
+        help="wiki to index (default: %(default)r)",
+    )
+
+    parser.add_argument(
+        "--language",
+        default="en",
+        help="language of wiki to index (default: %(default)r)",
+    )
+
+    return parser.parse_args(argv, namespace=IndexWikiArgsNamespace())
@@ -1,25 +1,50 @@
 from __future__ import annotations
 
 import logging
+import os
 import re
+import threading
 import time
-from functools import cached_property
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import partial
 from pathlib import Path
 from pprint import pformat
-from typing import Generic, Literal, Optional, TypeVar
-
-from mutagen.easymp4 import EasyMP4
-from utils_python import (
-    logPrefixFilter,
-    make_get_request_to_url,
-    print_tqdm,
-    run_on_path,
-    run_on_paths,
-)
+from typing import Generic, Iterable, Iterator, Optional, TypeVar
+
+from tqdm import tqdm
+from utils_python import print_tqdm
 
-from genreliser.acoustid_ import AcoustIDNotFoundError, get_acoustid
+from genreliser.acoustid_ import (
+    AcoustIDNotFoundError,
+    get_acoustid,
+    get_fingerprinted_content_hash,
+    iter_fingerprinted_batches,
+)
+from genreliser.discovery import iter_file_batches
+from genreliser.http_ import HostUnavailableError, get_json, get_unavailable_delay
 from genreliser.resolve import resolve_genre_list
-from genreliser.utils import clean_string, combine_listdicts
+from genreliser.store import (
+    ManifestEntry,
+    ResultStore,
+    Retry,
+    get_skip_reason,
+    normalise_path,
+)
+from genreliser.tags import SUFFIX_TAG_FUNCTIONS, Tags, get_tags
+from genreliser.utils import (
+    cached_property,
+    clean_string,
+    combine_listdicts,
+    hash_file,
+    thread_log_prefix,
+    with_thread_log_prefix,
+)
 
 LOGGER = logging.getLogger("genreliser")
 
@@ -35,30 +60,47 @@ PATTERN_GENRE_FROM_DESCRIPTION = r"^.*?Genre:\s*(?P<genres>.+?)\s*$"
 PATTERN_GENRES_FROM_LINE = r"#(\w+)"
 PATTERN_FEAT_FROM_ARTIST = r"^(.+?)(?: f(?:ea)?t\.? (.+))?$"
 
-SUFFIX_TAG_FUNCTIONS = {".m4a": EasyMP4}
+# times to retry files deferred because a source was down, before failing them
+DEFERRED_ROUNDS = 3
+
+# files found but not yet started, per worker, before discovery waits for them
+PENDING_FILES_PER_WORKER = 4
+
+# relative cost of fetching each source; cheaper sources are fetched first
+SOURCE_COSTS = {
+    # from the file's tags
+    "tags": 0,
+    "title": 0,
+    "description": 0,
+    # from the wiki (or its index)
+    "wiki": 1,
+    # fingerprinted, then looked up on AcoustID before being requested
+    "acousticbrainz": 2,
+    "musicbrainz": 2,
+}
+DEFAULT_SOURCE_COST = 1
+# sources that need files' AcoustIDs, and so their fingerprints
+ACOUSTID_SOURCES = {"acousticbrainz", "musicbrainz"}
 
 
 class DataNotFoundError(Exception):
     ...
 
 
-def get_tags(filepath: Path):
-    if (suffix_tag_function := SUFFIX_TAG_FUNCTIONS.get(filepath.suffix)) is None:
-        raise NotImplementedError(
-            f"{filepath.name}: suffix {filepath.suffix} not supported - must be in {SUFFIX_TAG_FUNCTIONS.keys}"
-        )
-    return suffix_tag_function(filepath)
-
-
 class BaseGenreliser:
     title_pattern: Optional[str] = None
     description_pattern_genre: str = PATTERN_GENRE_FROM_DESCRIPTION
+    # once cheaper sources have given all of these fields, costlier ones are skipped
+    confident_fields: list[str] = ["genres"]
 
     def __init__(
         self,
-        previous_failed_files=None,
-        previous_json_data=None,
-        retry: Literal["failed", "passed", "all"] | None = None,
+        store: ResultStore,
+        retry: Retry | None = None,
+        workers: int = 1,
+        hash_files: bool = False,
+        fingerprint_workers: int = 0,
+        fetch_all_sources: bool = False,
     ) -> None:
         self.music_file_type = MusicFile
         self.genres_to_files = {}
@@ -70,11 +112,33 @@ class BaseGenreliser:
         self.files_to_titles = {}
         self.files_without_titles = set()
 
-        self.failed_files: list[Path] = previous_failed_files or []
-        self.json_data: dict[Path, dict] = previous_json_data or {}
+        self.store = store
 
         self.retry = retry
 
+        self.workers = workers
+
+        # processes to fingerprint files with before processing them; 0 to not
+        self.fingerprint_workers = fingerprint_workers
+
+        # files that couldn't be processed because a source was down
+        self.deferred_filepaths: list[Path] = []
+
+        # normalised paths of files to process again even if unchanged
+        #  (e.g. because data they were processed with has since changed)
+        self.stale_paths: set[str] = set()
+
+        # compare files' contents (not just size and mtime) to detect changes
+        self.hash_files = hash_files
+
+        # fetch every source, even once cheaper ones have given `confident_fields`
+        self.fetch_all_sources = fetch_all_sources
+
+    @property
+    def skips_sources(self) -> bool:
+        """whether costlier sources may be skipped, by `confident_fields`"""
+        return not self.fetch_all_sources and bool(self.confident_fields)
+
     @property
     def results(self):
         return {
@@ -86,69 +150,217 @@ class BaseGenreliser:
             "files_without_titles": list(self.files_without_titles),
         }
 
+    def get_skip_reason(
+        self,
+        filepath: Path,
+        stat: os.stat_result,
+        entry: Optional[ManifestEntry],
+    ) -> Optional[str]:
+        if normalise_path(filepath) in self.stale_paths:
+            return None
+        reason = get_skip_reason(
+            entry,
+            stat,
+            self.retry,
+            partial(hash_file, filepath) if self.hash_files else None,
+        )
+        if reason is not None and entry.mtime_ns not in {None, stat.st_mtime_ns}:
+            # only the mtime changed, so don't compare the contents again next time
+            self.store.update_manifest_entry(filepath, stat)
+        return reason
+
     def genrelise_file(
         self,
         filepath: Path,
+        check_skip: bool = True,
+        defer: bool = True,
     ):
-        with logPrefixFilter(LOGGER, msg_prefix=f"['{filepath.name}']: "):
+        """
+        `check_skip` can be False if `filter_files` has already been applied.
+        If `defer`, files needing a source that's down are added to
+        `deferred_filepaths` instead of failing.
+        """
+        with thread_log_prefix(LOGGER, msg_prefix=f"['{filepath.name}']: "):
             LOGGER.info("starting...")
 
-            if filepath in self.failed_files:
-                if self.retry in {"failed", "all"}:
-                    self.failed_files.pop(self.failed_files.index(filepath))
-                else:
-                    LOGGER.info(
-                        "skipping; already in self.failed_files and self.retry=%s",
-                        self.retry,
+            # recorded with the result, once the file's been read
+            manifest_kwargs = {}
+            try:
+                # e.g. the file may have been deleted since it was found
+                stat = filepath.stat()
+                if check_skip and (
+                    reason := self.get_skip_reason(
+                        filepath, stat, self.store.get_manifest_entry(filepath)
                     )
+                ):
+                    LOGGER.info("skipping; %s", reason)
                     return
 
-            if filepath in self.json_data and self.retry not in {"passed", "all"}:
-                LOGGER.info(
-                    "skipping; already in self.json_data and self.retry=%s",
-                    self.retry,
-                )
-                return
-
-            filepath_str = str(filepath)
-
-            music_file = self.music_file_type(filepath, genreliser=self)
+                music_file = self.music_file_type(filepath, genreliser=self)
+                manifest_kwargs = {
+                    "stat": stat,
+                    "content_hash": (
+                        music_file.content_hash if self.hash_files else None
+                    ),
+                }
 
-            try:
                 fields = music_file.get_fields_from_sources()
                 if not fields or not any(fields.values()):
                     LOGGER.error(f"No data found")
-                    self.failed_files.append(str(filepath))
+                    self.store.set_failed(filepath, **manifest_kwargs)
+                    return
+            except HostUnavailableError as exc:
+                if not defer:
+                    LOGGER.error(exc)
+                    self.store.set_failed(filepath, **manifest_kwargs)
                     return
+                LOGGER.warning("deferring; %s", exc)
+                self.deferred_filepaths.append(filepath)
+                return
             except Exception as exc:
                 LOGGER.exception(exc, exc_info=not isinstance(exc, DataNotFoundError))
-                self.failed_files.append(str(filepath))
+                self.store.set_failed(filepath, **manifest_kwargs)
                 return
             fields_combined = music_file.fields_combined
             LOGGER.info("got combined fields: %s", fields_combined)
-            self.json_data[filepath_str] = fields_combined
+            self.store.set_passed(filepath, fields_combined, **manifest_kwargs)
 
             LOGGER.info("...finished")
 
+    def filter_files(
+        self,
+        filepaths: list[Path],
+        manifest: Optional[dict[str, ManifestEntry]] = None,
+    ) -> list[Path]:
+        """
+        Returns only the files that are new, changed or being retried,
+        checking them against the whole manifest at once (loaded if not given)
+        """
+        if manifest is None:
+            manifest = self.store.get_manifest()
+        filepaths_filtered = []
+        for filepath in filepaths:
+            entry = manifest.get(normalise_path(filepath))
+            try:
+                reason = self.get_skip_reason(filepath, filepath.stat(), entry)
+            except OSError:
+                # left to fail (and be recorded) when the file is processed
+                reason = None
+            if reason:
+                LOGGER.debug("skipping '%s'; %s", filepath, reason)
+            else:
+                filepaths_filtered.append(filepath)
+        return filepaths_filtered
+
+    def iter_files(self, paths: list[Path]) -> Iterator[list[Path]]:
+        """
+        Yields the supported files in `paths` (recursively) to process, i.e. those
+        that are new, changed or being retried, a folder at a time as they're found
+        """
+        manifest = self.store.get_manifest()
+        found = 0
+        skipped = 0
+        for filepaths in iter_file_batches(paths, SUFFIX_TAG_FUNCTIONS):
+            filepaths_filtered = self.filter_files(filepaths, manifest)
+            found += len(filepaths)
+            skipped += len(filepaths) - len(filepaths_filtered)
+            if filepaths_filtered:
+                yield filepaths_filtered
+        LOGGER.info("skipped %s of %s files", skipped, found)
+
     def genrelise_path(
         self,
         path: Path,
     ):
-        return run_on_path(
-            path,
-            file_callback=self.genrelise_file,
-            # dir_callback=self.run_on_dir,
-        )
+        return self.genrelise_paths([path])
 
     def genrelise_paths(
         self,
         paths: list[Path],
     ):
-        return run_on_paths(
-            paths,
-            file_callback=self.genrelise_file,
-            # dir_callback=self.run_on_dir,
-        )
+        batches: Iterable[list[Path]] = self.iter_files(paths)
+
+        uses_acoustid = ACOUSTID_SOURCES & set(self.music_file_type.default_sources)
+        if self.fingerprint_workers and not uses_acoustid:
+            LOGGER.info("not fingerprinting files, as no source uses their AcoustIDs")
+        elif self.fingerprint_workers:
+            batches = iter_fingerprinted_batches(batches, self.fingerprint_workers)
+
+        # started as they're found, rather than once every file has been
+        self.genrelise_file_batches(batches)
+        self.genrelise_deferred_files()
+
+    def genrelise_files(self, filepaths: list[Path], defer: bool = True):
+        self.genrelise_file_batches([filepaths], defer=defer)
+
+    def genrelise_file_batches(self, batches: Iterable[list[Path]], defer: bool = True):
+        """
+        `batches` may be a generator (e.g. of files still being found), which
+        is only consumed as workers become free; each batch is added to the
+        progress bar's total as it arrives
+        """
+        with tqdm(total=0, unit="file") as progress:
+
+            def iter_filepaths():
+                for filepaths in batches:
+                    progress.total += len(filepaths)
+                    progress.refresh()
+                    yield from filepaths
+
+            if self.workers <= 1:
+                for filepath in iter_filepaths():
+                    self.genrelise_file(filepath, check_skip=False, defer=defer)
+                    progress.update()
+                return
+
+            LOGGER.info("processing files with %s workers", self.workers)
+            max_pending = self.workers * PENDING_FILES_PER_WORKER
+            with ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="genrelise"
+            ) as executor:
+                futures: set[Future] = set()
+                try:
+                    for filepath in iter_filepaths():
+                        if len(futures) >= max_pending:
+                            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                future.result()
+                            progress.update(len(done))
+                        futures.add(
+                            executor.submit(
+                                self.genrelise_file,
+                                filepath,
+                                check_skip=False,
+                                defer=defer,
+                            )
+                        )
+                    for future in as_completed(futures):
+                        future.result()
+                        progress.update()
+                except BaseException:
+                    # don't start any more files if one crashed or we were interrupted
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
+    def genrelise_deferred_files(self):
+        """
+        Retries files deferred because a source was down, once it may be up again,
+        failing any still deferred after the last round
+        """
+        for round_ in range(1, DEFERRED_ROUNDS + 1):
+            if not self.deferred_filepaths:
+                return
+            filepaths, self.deferred_filepaths = self.deferred_filepaths, []
+            if (delay := get_unavailable_delay()) > 0:
+                LOGGER.info("waiting %.0fs for unavailable sources", delay)
+                time.sleep(delay)
+            LOGGER.info(
+                "retrying %s deferred files (round %s of %s)",
+                len(filepaths),
+                round_,
+                DEFERRED_ROUNDS,
+            )
+            self.genrelise_files(filepaths, defer=round_ < DEFERRED_ROUNDS)
 
     def run_on_file(self, file: Path):
         if not isinstance(file, Path):
@@ -180,6 +392,17 @@ GenreliserType = TypeVar("GenreliserType", bound=BaseGenreliser)
 
 
 class MusicFile(Generic[GenreliserType]):
+    # sources whose fields each source is derived from, and so must be fetched first
+    source_dependencies: dict[str, set[str]] = {}
+    source_costs: dict[str, int] = SOURCE_COSTS
+    default_sources: list[str] = [
+        # "acousticbrainz",
+        # "musicbrainz",
+        "title",
+        # "description",
+        # "tags",
+    ]
+
     def __init__(
         self,
         filepath: Path,
@@ -189,27 +412,48 @@ class MusicFile(Generic[GenreliserType]):
         self.filepath = filepath
         self.logger = logger
         self.genreliser = genreliser
-        self.tags = get_tags(self.filepath)
-        self.tag_title: str = self.tags["title"][0]
-        self.tag_description: str = self.tags["description"][0]
         self.acoustid_fields = {}
-        self.sources = [
-            # "acousticbrainz",
-            # "musicbrainz",
-            "title",
-            # "description",
-            # "tags",
-        ]
+        # the acoustid is shared by sources, which may be fetched concurrently
+        self.acoustid_lock = threading.Lock()
+        self.sources = list(self.default_sources)
+        # why each source that wasn't fetched was skipped
+        self.skipped_sources: dict[str, str] = {}
         self.genre_exclusions = set()
 
     def __repr__(self) -> str:
         return f"<{self.__module__}.{self.__class__.__name__} '{self.filepath}'>"
 
-    # @cached_property
+    @cached_property
+    def tags(self) -> Tags:
+        return get_tags(self.filepath)
+
     @property
+    def tag_title(self) -> str:
+        # untitled files are usually named after their title
+        return (self.tags.get("title") or [self.filepath.stem])[0]
+
+    @property
+    def tag_description(self) -> str:
+        return (self.tags.get("description") or [""])[0]
+
+    @property
+    def tag_album(self) -> Optional[str]:
+        return (self.tags.get("album") or [None])[0]
+
+    @cached_property
+    def content_hash(self) -> str:
+        return get_fingerprinted_content_hash(self.filepath) or hash_file(self.filepath)
+
+    @cached_property
     def acoustid(self):
+        with self.acoustid_lock:
+            if "acoustid" not in self.__dict__:
+                self.__dict__["acoustid"] = self.lookup_acoustid()
+            return self.__dict__["acoustid"]
+
+    def lookup_acoustid(self):
         try:
-            self.acoustid_fields = get_acoustid(self.filepath)
+            self.acoustid_fields = get_acoustid(self.filepath, self.content_hash)
             return self.acoustid_fields["acoustid"]
         except AcoustIDNotFoundError as exc:
             LOGGER.warning(exc, exc_info=1)
@@ -221,7 +465,7 @@ class MusicFile(Generic[GenreliserType]):
         if self.acoustid is None:
             return {}
         url = f"https://acousticbrainz.org/api/v1/{self.acoustid}/low-level"
-        res_json = make_get_request_to_url(url, src_key="acousticbrainz")
+        res_json = get_json(url, src_key="acousticbrainz")
         if res_json is None:
             return {}
         res_metadata = res_json["metadata"]
@@ -281,7 +525,7 @@ class MusicFile(Generic[GenreliserType]):
         ]
         # includes = ["genres", "artists", "isrcs"]
         url = f"https://musicbrainz.org/ws/2/recording/{self.acoustid}?inc={'+'.join(includes)}&fmt=json"
-        res_json = make_get_request_to_url(url, src_key="musicbrainz")
+        res_json = get_json(url, src_key="musicbrainz")
         title_aliases = get_aliases_musicbrainz(res_json)
         res_tags_processed = {
             # "mbid": res_json["id"],
@@ -402,12 +646,111 @@ class MusicFile(Generic[GenreliserType]):
         LOGGER.info("got fields from title: %s", fields_from_title)
         return fields_from_title
 
+    def get_fields_from_source(self, source: str, dependencies: list[Future]):
+        for dependency in dependencies:
+            # re-raises the dependency's exception, if it failed
+            dependency.result()
+        fields = getattr(self, f"fields_from_{source}")
+        # also keep uncached properties' fields, for `fields_from_sources`
+        self.__dict__[f"fields_from_{source}"] = fields
+        return fields
+
+    def get_source_cost(self, source: str) -> int:
+        return self.source_costs.get(source, DEFAULT_SOURCE_COST)
+
+    def get_source_skip_reason(self, fetched_sources: list[str]) -> Optional[str]:
+        """
+        why the sources not yet fetched needn't be, if the genreliser's
+        `confident_fields` are all known from `fetched_sources`
+        """
+        if not self.genreliser.skips_sources:
+            return None
+        fields_combined = self.get_fields_combined(fetched_sources)
+        for field_name in self.genreliser.confident_fields:
+            values = fields_combined.get(field_name)
+            if field_name == "genres":
+                # excluded genres (e.g. the label's name) don't count
+                values = resolve_genre_list(values or [], self.genre_exclusions)
+            if not values:
+                return None
+        confident_sources = [
+            source
+            for source in fetched_sources
+            if any(
+                self.__dict__.get(f"fields_from_{source}", {}).get(field_name)
+                for field_name in self.genreliser.confident_fields
+            )
+        ]
+        return (
+            f"already have {', '.join(self.genreliser.confident_fields)}"
+            f" from {', '.join(confident_sources)}"
+        )
+
     def get_fields_from_sources(self):
-        """generates fields"""
+        """
+        generates fields, fetching sources concurrently, cheapest first; a source
+        waits for those in its `source_dependencies`, and costlier sources are
+        skipped once cheaper ones have given the genreliser's `confident_fields`
+        (if none can be, every source is fetched at once)
+        """
+        futures: dict[str, Future] = {}
+        get_fields_from_source = with_thread_log_prefix(
+            LOGGER, self.get_fields_from_source
+        )
+
+        def submit(source: str, executor: ThreadPoolExecutor, submitting: set[str]):
+            if source in futures:
+                return futures[source]
+            if source in submitting:
+                raise ValueError(f"circular source dependencies: {submitting}")
+            dependencies = [
+                submit(dependency, executor, submitting | {source})
+                for dependency in sorted(self.source_dependencies.get(source, ()))
+                if dependency in self.sources
+            ]
+            futures[source] = executor.submit(
+                get_fields_from_source, source, dependencies
+            )
+            return futures[source]
+
+        # a thread per source, so sources waiting for others never starve them
+        with ThreadPoolExecutor(
+            max_workers=len(self.sources), thread_name_prefix="source"
+        ) as executor:
+            if self.genreliser.skips_sources:
+                costs = sorted(set(map(self.get_source_cost, self.sources)))
+                tiers = [
+                    [
+                        source
+                        for source in self.sources
+                        if self.get_source_cost(source) == cost
+                    ]
+                    for cost in costs
+                ]
+            else:
+                tiers = [self.sources]
+            for tier in tiers[:-1]:
+                for source in tier:
+                    submit(source, executor, set())
+                # only the tiers before the last could cause sources to be skipped
+                wait(futures.values())
+                if any(future.exception() for future in futures.values()):
+                    break
+                if reason := self.get_source_skip_reason(list(futures)):
+                    for source in self.sources:
+                        if source not in futures:
+                            LOGGER.info("skipping %s; %s", source, reason)
+                            self.skipped_sources[source] = reason
+                    break
+            else:
+                for source in tiers[-1]:
+                    submit(source, executor, set())
+
+        # in the order of `self.sources`, so the first to fail is always raised
         fields = {
             source: fields
             for source in self.sources
-            if (fields := getattr(self, f"fields_from_{source}")) is not None
+            if source in futures and (fields := futures[source].result()) is not None
         }
         return fields
 
@@ -422,11 +765,27 @@ class MusicFile(Generic[GenreliserType]):
 
     @property
     def fields_combined(self):
-        fields_combined = combine_listdicts(self.fields_from_sources.values())
+        return self.get_fields_combined()
+
+    def get_fields_combined(self, sources: Optional[Iterable[str]] = None):
+        """combines fields from `sources` (default: all) in `self.sources` order"""
+        sources = self.sources if sources is None else set(sources)
+        fields_combined = combine_listdicts(
+            [
+                value
+                for key, value in self.fields_from_sources.items()
+                if key.removeprefix("fields_from_") in sources
+            ]
+        )
         genres_resolved = resolve_genre_list(
             fields_combined.get("genres", []), self.genre_exclusions
         )
         if genres_resolved:
             fields_combined["genres"] = genres_resolved
-        fields_combined["sources"] = self.sources
+        # each source, with why it was skipped if it was (or None)
+        fields_combined["sources"] = {
+            source: self.skipped_sources.get(source)
+            for source in self.sources
+            if source in sources
+        }
         return fields_combined
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from genreliser.utils import connect_sqlite
+
+LOGGER = logging.getLogger("genreliser")
+
+DAY = 24 * 60 * 60
+
+# how long a response from each source stays fresh, in seconds
+SOURCE_TTLS = {
+    "fandom": 7 * DAY,
+    "musicbrainz": 30 * DAY,
+    "acousticbrainz": 365 * DAY,  # no longer updated upstream
+    "acoustid": 30 * DAY,
+    "github": 1 * DAY,
+    # negative results, kept for less time as pages may be created at any time
+    "fandom_missing_page": 3 * DAY,
+    "fandom_no_song_results": 3 * DAY,
+}
+DEFAULT_TTL = 1 * DAY
+
+DEFAULT_CACHE_DIR = Path("data/cache")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# after exceeding max_bytes, evict least-recently-used entries down to this fraction
+EVICTION_TARGET_RATIO = 0.9
+
+
+def normalise_request_url(url: str, params: Optional[dict[str, Any]] = None) -> str:
+    """
+    Returns `url` with `params` merged into its query string, with the scheme and host
+    lowercased and the query parameters sorted, so equivalent requests compare equal
+    """
+    split = urlsplit(url)
+    query = parse_qsl(split.query, keep_blank_values=True)
+    for key, value in (params or {}).items():
+        if isinstance(value, bytes):
+            value = value.decode()
+        query.append((key, str(value)))
+    return urlunsplit(
+        (
+            split.scheme.lower(),
+            split.netloc.lower(),
+            split.path,
+            urlencode(sorted(query)),
+            "",
+        )
+    )
+
+
+def get_request_key(url: str, params: Optional[dict[str, Any]] = None) -> str:
+    return hashlib.sha256(normalise_request_url(url, params).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed store of decoded JSON responses, keyed by a hash of the normalised
+    request URL, with per-source TTLs and least-recently-used eviction once the
+    stored responses exceed `max_bytes`
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttls: Optional[dict[str, float]] = None,
+    ) -> None:
+        self.path = cache_dir / "responses.sqlite"
+        self.max_bytes = max_bytes
+        self.ttls = SOURCE_TTLS if ttls is None else ttls
+        self.lock = threading.Lock()
+        self.connection = connect_sqlite(self.path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                url TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+        )
+        (self.size,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        LOGGER.info(
+            "using response cache '%s' (%.1f MiB)", self.path, self.size / 2**20
+        )
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.path}'>"
+
+    def get_ttl(self, source: str) -> float:
+        return self.ttls.get(source, DEFAULT_TTL)
+
+    def get(self, source: str, key: str) -> tuple[bool, Any]:
+        """returns (hit, value)"""
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, size, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return False, None
+            value, size, created_at = row
+            if now - created_at > self.get_ttl(source):
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+                return False, None
+            self.connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return True, json.loads(value)
+
+    def set(self, source: str, key: str, url: str, value: Any) -> None:
+        now = time.time()
+        value_str = json.dumps(value)
+        size = len(value_str)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, source, url, value_str, size, now, now),
+            )
+            self.size += size - (row[0] if row else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        target = self.max_bytes * EVICTION_TARGET_RATIO
+        freed = 0
+        keys = []
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ):
+            if self.size - freed <= target:
+                break
+            keys.append((key,))
+            freed += size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.size -= freed
+        LOGGER.info(
+            "evicted %s responses (%.1f MiB) from cache", len(keys), freed / 2**20
+        )
+
+    def cached(
+        self,
+        source: str,
+        url: str,
+        params: Optional[dict[str, Any]],
+        fetch: Callable[[], Any],
+        should_cache: Callable[[Any], bool] = lambda value: value is not None,
+    ):
+        """returns the cached response for the request, calling `fetch` on a miss"""
+        key = get_request_key(url, params)
+        hit, value = self.get(source, key)
+        if hit:
+            LOGGER.debug("cache hit for %s", url)
+            return value
+        value = fetch()
+        if should_cache(value):
+            self.set(source, key, normalise_request_url(url, params), value)
+        return value
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def configure_response_cache(cache_dir: Optional[Path]) -> Optional[ResponseCache]:
+    """sets the cache used by `cached_response`; disabled if `cache_dir` is None"""
+    global _response_cache
+    _response_cache = None if cache_dir is None else ResponseCache(cache_dir)
+    return _response_cache
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return _response_cache
+
+
+def cached_response(
+    source: str,
+    url: str,
+    params: Optional[dict[str, Any]],
+    fetch: Callable[[], Any],
+    should_cache: Callable[[Any], bool] = lambda value: value is not None,
+):
+    if _response_cache is None:
+        return fetch()
+    return _response_cache.cached(source, url, params, fetch, should_cache)
+
+
+# negative results, by source, when the response cache is disabled
+_misses: dict[str, set[str]] = {}
+
+
+def get_miss_key(source: str, descriptor: str) -> str:
+    return hashlib.sha256(f"{source}:{descriptor}".encode()).hexdigest()
+
+
+def is_cached_miss(source: str, descriptor: str) -> bool:
+    """
+    whether `descriptor` (e.g. a page title) is known to have had no result
+    from `source`, within its TTL
+    """
+    if _response_cache is None:
+        return descriptor in _misses.get(source, ())
+    hit, _value = _response_cache.get(source, get_miss_key(source, descriptor))
+    return hit
+
+
+def cache_miss(source: str, descriptor: str):
+    """records that `descriptor` had no result from `source`"""
+    if _response_cache is None:
+        _misses.setdefault(source, set()).add(descriptor)
+        return
+    _response_cache.set(
+        source, get_miss_key(source, descriptor), f"{source}:{descriptor}", True
+    )
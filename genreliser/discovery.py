@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterable, Iterator
+
+LOGGER = logging.getLogger("genreliser")
+
+# directories scanned at once
+DISCOVERY_WORKERS = 4
+# directories scanned ahead of the files found so far being consumed
+MAX_PENDING_SCANS = 16
+
+
+def has_suffix(path: Path | os.DirEntry, suffixes: set[str]) -> bool:
+    return os.path.splitext(path.name)[1].lower() in suffixes
+
+
+def scan_dir(dir_path: Path, suffixes: set[str]) -> tuple[list[Path], list[Path]]:
+    """the files with one of `suffixes` directly in `dir_path`, and its subfolders"""
+    filepaths = []
+    dir_paths = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_paths.append(Path(entry.path))
+                elif entry.is_file() and has_suffix(entry, suffixes):
+                    filepaths.append(Path(entry.path))
+    except OSError as exc:
+        LOGGER.warning("couldn't scan '%s': %s", dir_path, exc)
+    return sorted(filepaths), sorted(dir_paths)
+
+
+def iter_file_batches(
+    paths: Iterable[Path],
+    suffixes: Iterable[str],
+    workers: int = DISCOVERY_WORKERS,
+    max_pending: int = MAX_PENDING_SCANS,
+) -> Iterator[list[Path]]:
+    """
+    Yields the files with one of `suffixes` in each folder (recursively) as soon as
+    it's been scanned, scanning up to `max_pending` folders ahead on `workers`
+    threads; files in `paths` are yielded first, and other suffixes are skipped
+    """
+    suffixes = {suffix.lower() for suffix in suffixes}
+    dir_paths: deque[Path] = deque()
+    filepaths = []
+    for path in paths:
+        if path.is_dir():
+            dir_paths.append(path)
+        elif not path.exists():
+            LOGGER.warning("'%s' not found", path)
+        elif has_suffix(path, suffixes):
+            filepaths.append(path)
+        else:
+            LOGGER.warning(
+                "skipping '%s'; suffix %s not supported - must be in %s",
+                path,
+                path.suffix,
+                sorted(suffixes),
+            )
+    if filepaths:
+        yield filepaths
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="discovery"
+    ) as executor:
+        pending: set[Future] = set()
+        try:
+            while dir_paths or pending:
+                while dir_paths and len(pending) < max_pending:
+                    pending.add(
+                        executor.submit(scan_dir, dir_paths.popleft(), suffixes)
+                    )
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filepaths, subdir_paths = future.result()
+                    dir_paths.extend(subdir_paths)
+                    if filepaths:
+                        yield filepaths
+        finally:
+            # e.g. if processing stopped, don't keep scanning
+            for future in pending:
+                future.cancel()
@@ -1,70 +1,255 @@
 from __future__ import annotations
 
-from functools import cached_property
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Iterable, Optional
 from urllib.parse import quote
 
 import fandom.error
 import fandom.fandom
 import fandom.util
+import requests
 from bs4 import BeautifulSoup
 from fandom.FandomPage import STANDARD_URL, FandomPage
-from utils_python import ensure_caps
+from utils_python import deduplicate, ensure_caps
 
+from genreliser.cache import cache_miss, cached_response, is_cached_miss
+from genreliser.http_ import request
+from genreliser.utils import cached_property
 
-def resolve_wiki(wiki: str):
-    return wiki or fandom.fandom.WIKI or "runescape"
+if TYPE_CHECKING:
+    from genreliser.wiki_index import WikiIndex
 
+API_URL = "https://{wiki}.fandom.com/{lang}/api.php"
+# maximum number of titles/pageids per query for non-bot users
+QUERY_BATCH_SIZE = 50
+# pages kept per wiki, each under its pageid and title(s)
+PAGE_CACHE_SIZE = 2048
 
-def resolve_language(language: str):
-    return language or fandom.fandom.LANG or "en"
+
+class PageCache:
+    """
+    Recently-used pages, by class and pageid or title, so that the same page isn't
+    loaded again when it's found by a different identifier
+    """
+
+    def __init__(self, max_size: int = PAGE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.pages: OrderedDict[
+            tuple[type, int | str], EnhancedFandomPage
+        ] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def get(self, cls: type, identifier: int | str) -> Optional[EnhancedFandomPage]:
+        with self.lock:
+            if (page := self.pages.get((cls, identifier))) is not None:
+                self.pages.move_to_end((cls, identifier))
+        return page
+
+    def add(self, page: EnhancedFandomPage, *identifiers: int | str):
+        """adds `page` under its pageid and title, and any other `identifiers`"""
+        with self.lock:
+            for identifier in {page.pageid, page.title, *identifiers}:
+                if identifier is None:
+                    continue
+                self.pages[(type(page), identifier)] = page
+                self.pages.move_to_end((type(page), identifier))
+            while len(self.pages) > self.max_size:
+                self.pages.popitem(last=False)
+
+
+class WikiClient:
+    """
+    A wiki in one language, with requests to it made through a source's rate limit,
+    keep-alive session and response cache, instead of fandom-py's global wiki;
+    `index` is a local index of its song pages (e.g. from `genrelise index-wiki`)
+    to look pages up in before searching, if any
+    """
+
+    def __init__(
+        self,
+        wiki: str,
+        language: str = "en",
+        source: str = "fandom",
+        index: Optional[WikiIndex] = None,
+    ):
+        self.wiki = wiki.lower()
+        self.language = language.lower()
+        self.source = source
+        self.api_url = API_URL.format(wiki=self.wiki, lang=self.language)
+        self.pages = PageCache()
+        self.index = index
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.wiki}' ({self.language})>"
+
+    def get_page_url(self, title: str) -> str:
+        return STANDARD_URL.format(
+            lang=self.language, wiki=self.wiki, page=quote(title)
+        )
+
+    def get_descriptor(self, name: str) -> str:
+        """identifies e.g. a title or search query in the wiki, for negative caching"""
+        return f"{self.wiki}/{self.language}:{name}"
+
+    def request(self, params: dict, cached: bool = True):
+        """
+        fandom.util._wiki_request, but rate limited and through a shared session,
+        with responses cached on disk unless `cached` is False.
+        Raises requests.HTTPError if the wiki responds with an error status.
+        """
+
+        def fetch():
+            response = request(
+                self.source, "GET", self.api_url, params={**params, "format": "json"}
+            )
+            response.raise_for_status()
+            return response.json()
+
+        if not cached:
+            return fetch()
+        return cached_response(
+            self.source,
+            self.api_url,
+            params,
+            fetch,
+            should_cache=lambda response: "error" not in response,
+        )
 
 
 # @fandom.util.cache
-def search(
-    query: str,
-    wiki: str = fandom.fandom.WIKI,
-    language: str = fandom.fandom.LANG,
-    results: int = 10,
-):
+def search(client: WikiClient, query: str, results: int = 10):
     search_params = lambda query: {
         "action": "query",
-        "wiki": resolve_wiki(wiki),
-        "lang": resolve_language(language),
         "srlimit": results,
         "list": "search",
         "srsearch": query,
     }
 
-    raw_results = fandom.util._wiki_request(search_params(query))
-    # breakpoint()
-
     try:
+        raw_results = client.request(search_params(query))
+        # breakpoint()
         search_results = [
             (d["title"], d["pageid"]) for d in raw_results["query"]["search"]
         ]
-    except KeyError:
-        raise fandom.fandom.FandomError(query, wiki, language)
+    except (KeyError, requests.HTTPError):
+        raise fandom.fandom.FandomError(query, client.wiki, client.language)
     return list(search_results)
 
 
+def iter_query_responses(client: WikiClient, query_params: dict, cached: bool = True):
+    """yields each response to a query, following continuations"""
+    while True:
+        response = client.request(query_params, cached=cached)
+        yield response
+        if "continue" not in response:
+            return
+        query_params = {**query_params, **response["continue"]}
+
+
+def merge_page_data(existing: dict, new: dict):
+    # continued queries return further entries of list-valued props (e.g. categories)
+    for key, value in new.items():
+        if isinstance(value, list):
+            existing.setdefault(key, []).extend(value)
+        elif isinstance(value, dict):
+            existing.setdefault(key, {}).update(value)
+        else:
+            existing[key] = value
+
+
+def query_pages(
+    client: WikiClient,
+    pageids: Iterable[int] = (),
+    titles: Iterable[str] = (),
+    params: Optional[dict] = None,
+) -> tuple[dict[str, dict], dict[str, str]]:
+    """
+    Queries `params` (e.g. `prop`) for many pages at once, QUERY_BATCH_SIZE per request.
+    Returns the pages by title, and the title each requested title resolved to
+    (after normalisation and redirects).
+    Titles recently found not to exist aren't queried again.
+    """
+    pages: dict[str, dict] = {}
+    renames: dict[str, str] = {}
+    titles = [
+        title
+        for title in deduplicate(list(titles))
+        if "|" not in title
+        and not is_cached_miss("fandom_missing_page", client.get_descriptor(title))
+    ]
+    pageids = deduplicate(list(pageids))
+    for key, identifiers in (("pageids", pageids), ("titles", titles)):
+        for i in range(0, len(identifiers), QUERY_BATCH_SIZE):
+            query_params = {
+                "action": "query",
+                "redirects": "",
+                **(params or {}),
+                key: "|".join(map(str, identifiers[i : i + QUERY_BATCH_SIZE])),
+            }
+            for response in iter_query_responses(client, query_params):
+                query = response.get("query", {})
+                for rename in query.get("normalized", []) + query.get("redirects", []):
+                    renames[rename["from"]] = rename["to"]
+                for page in query.get("pages", {}).values():
+                    if "title" not in page:
+                        # a missing pageid, which has no title to be found by
+                        continue
+                    merge_page_data(pages.setdefault(page["title"], {}), page)
+
+    def resolve_title(title: str):
+        seen = set()
+        while title in renames and title not in seen:
+            seen.add(title)
+            title = renames[title]
+        return title
+
+    title_resolutions = {title: resolve_title(title) for title in titles}
+    for title, title_resolved in title_resolutions.items():
+        page = pages.get(title_resolved)
+        if page is None or "missing" in page or "invalid" in page:
+            cache_miss("fandom_missing_page", client.get_descriptor(title))
+    return pages, title_resolutions
+
+
+def get_latest_revisions(
+    client: WikiClient, pageids: Iterable[int]
+) -> dict[int, tuple[int, str]]:
+    """
+    Returns the current (revid, title) of each page that still exists, asking for
+    only revision ids (never cached), QUERY_BATCH_SIZE pages per request
+    """
+    pageids = deduplicate(list(pageids))
+    revisions: dict[int, tuple[int, str]] = {}
+    for i in range(0, len(pageids), QUERY_BATCH_SIZE):
+        query_params = {
+            "action": "query",
+            "prop": "revisions",
+            "rvprop": "ids",
+            "pageids": "|".join(map(str, pageids[i : i + QUERY_BATCH_SIZE])),
+        }
+        for response in iter_query_responses(client, query_params, cached=False):
+            for page in response.get("query", {}).get("pages", {}).values():
+                if page_revisions := page.get("revisions"):
+                    revisions[page["pageid"]] = (
+                        page_revisions[0]["revid"],
+                        page["title"],
+                    )
+    return revisions
+
+
 class EnhancedFandomPage(FandomPage):
-    # instances_by_title_cache: dict[int, EnhancedFandomPage] = {}
-    # instances_by_id_cache: dict[str, EnhancedFandomPage] = {}
-
-    def __new__(cls, identifier: str | int, **_kwargs):
-        # average time complexity is O(1), so just look in
-        #  both dicts and return a new instance if not found
-        return (
-            # cls.instances_by_title_cache.get(identifier)
-            # or cls.instances_by_id_cache.get(identifier) or
-            super().__new__(cls)
-        )
+    def __new__(cls, identifier: str | int, client: WikiClient, *_args, **_kwargs):
+        # reuse the instance for the same page, if it's been loaded recently
+        return client.pages.get(cls, identifier) or super().__new__(cls)
 
     def __init__(
         self,
         identifier: str | int,
-        wiki: str = fandom.fandom.WIKI,
-        language: str = fandom.fandom.LANG,
+        client: WikiClient,
         redirect: bool = True,
         preload: bool = False,
     ):
@@ -79,17 +264,48 @@ class EnhancedFandomPage(FandomPage):
         title = identifier if isinstance(identifier, str) else None
         pageid = identifier if isinstance(identifier, int) else None
 
+        self.client = client
+        # pages are shared between threads, so `record` is only extracted by one
+        self.record_lock = threading.Lock()
         super().__init__(
-            resolve_wiki(wiki),
-            resolve_language(language),
+            client.wiki,
+            client.language,
             title,
             pageid,
             redirect,
             preload,
         )
 
-        # self.instances_by_id_cache[self.pageid] = self
-        # self.instances_by_title_cache[self.title] = self
+        # also under `identifier`, as the title loaded may be capitalised or redirected
+        client.pages.add(self, identifier)
+
+    @classmethod
+    def from_record(
+        cls,
+        pageid: int,
+        title: str,
+        url: str,
+        record: Optional[dict],
+        client: WikiClient,
+        revid: Optional[int] = None,
+    ):
+        """
+        creates a page from previously-extracted data, without loading it;
+        if `record` is None, it's extracted from the page (at `revid`) when needed
+        """
+        page = object.__new__(cls)
+        page.client = client
+        page.record_lock = threading.Lock()
+        page.wiki = client.wiki
+        page.language = client.language
+        page.pageid = pageid
+        page.title = title
+        page.url = url
+        page.revid = revid
+        if record is not None:
+            page.__dict__["record"] = record
+        client.pages.add(page)
+        return page
 
     def __hash__(self) -> int:
         # allows pages to be used in places that require hashable values
@@ -107,14 +323,44 @@ class EnhancedFandomPage(FandomPage):
     def _FandomPage__load(self, redirect=True, preload=False):
         # now properly escapes special characters in title before setting `self.url`
         try:
-            super()._FandomPage__load(redirect, preload)
+            self.__load(redirect, preload)
         except fandom.error.PageError:
-            self.title, title_old = ensure_caps(self.title), self.title
-            super()._FandomPage__load(redirect, preload)
-            # self.instances_by_title_cache[title_old] = self
-        self.url = STANDARD_URL.format(
-            lang=self.language, wiki=self.wiki, page=quote(self.title)
-        )
+            if getattr(self, "title", None) is None:
+                raise
+            self.title = ensure_caps(self.title)
+            self.__load(redirect, preload)
+        self.url = self.client.get_page_url(self.title)
+
+    def __load(self, redirect=True, preload=False):
+        # FandomPage.__load, but requesting through `self.client`
+        query_params = {
+            "action": "query",
+            "prop": "info|pageprops",
+            "inprop": "url",
+            "ppprop": "disambiguation",
+            "redirects": "",
+        }
+        if getattr(self, "pageid", None) is None:
+            query_params["titles"] = self.title
+        else:
+            query_params["pageids"] = self.pageid
+
+        query = self.client.request(query_params)["query"]
+        page = next(iter(query["pages"].values()))
+
+        if "missing" in page or "invalid" in page:
+            if getattr(self, "pageid", None) is None:
+                raise fandom.error.PageError(None, self.title)
+            raise fandom.error.PageError(pageid=self.pageid)
+        if "redirects" in query and not redirect:
+            raise fandom.error.RedirectError(getattr(self, "title", page["title"]))
+
+        self.pageid = page["pageid"]
+        self.title = page["title"]
+        self.url = page["fullurl"]
+        self.revid = page.get("lastrevid")
+        if preload:
+            self.html
 
     @property
     def id(self):
@@ -123,11 +369,44 @@ class EnhancedFandomPage(FandomPage):
     # @cached_property
     @property
     def html(self):
-        # now cached
-        return super().html
+        # now requested through `self.client`
+        # returns what it fetched, as another thread may discard `_html` meanwhile
+        if html := getattr(self, "_html", None):
+            return html
+        # by revision if known, so a cached response can't be of an older one
+        if getattr(self, "revid", None) is None:
+            query_params = {"action": "parse", "pageid": self.pageid}
+        else:
+            query_params = {"action": "parse", "oldid": self.revid}
+        parse = self.client.request(query_params)["parse"]
+        html = self._html = parse["text"]["*"]
+        # the revision the html (and so `record`) is from
+        self.revid = parse.get("revid", getattr(self, "revid", None))
+        return html
 
-    # @cached_property
-    @property
-    def soup(self):
-        # now a cached property
-        return BeautifulSoup(self.html, "html.parser")
+    @cached_property
+    def record(self) -> dict:
+        """
+        Compact data extracted from a single parse of the page's html,
+        which is discarded afterwards
+        """
+        with self.record_lock:
+            if "record" in self.__dict__:
+                # extracted by another thread while this one waited
+                return self.__dict__["record"]
+            html = self.html
+            record = self.extract_record(html, BeautifulSoup(html, "html.parser"))
+            # cached before the lock is released, so it's only extracted once
+            self.__dict__["record"] = record
+            self._html = None
+            return record
+
+    def extract_record(self, html: str, soup: BeautifulSoup) -> dict:
+        """override to extract the fields needed from the page"""
+        return {
+            "categories": [
+                li["data-name"]
+                for li in soup.find_all("li", {"class": "category"})
+                if li.has_attr("data-name")
+            ],
+        }
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import heapq
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Callable, Generic, TypeVar
+
+ValueType = TypeVar("ValueType")
+
+# how many trigram candidates to rescore with SequenceMatcher per result wanted
+RESCORE_FACTOR = 4
+
+
+def get_trigrams(string: str) -> set[str]:
+    padded = f"  {string} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex(Generic[ValueType]):
+    """
+    In-memory inverted index from character trigrams to strings, for finding the
+    strings most similar to a query without comparing it against every one
+    """
+
+    def __init__(self, normalise: Callable[[str], str] = str.casefold) -> None:
+        self.normalise = normalise
+        self.strings: list[str] = []
+        self.values: list[ValueType] = []
+        self.trigram_counts: list[int] = []
+        self.postings: dict[str, list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def add(self, string: str, value: ValueType):
+        string = self.normalise(string)
+        i = len(self.strings)
+        trigrams = get_trigrams(string)
+        self.strings.append(string)
+        self.values.append(value)
+        self.trigram_counts.append(len(trigrams))
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, []).append(i)
+
+    def query(
+        self, query: str, k: int = 10, threshold: float = 0.0
+    ) -> list[tuple[float, str, ValueType]]:
+        """
+        Returns up to `k` (similarity, string, value) tuples, most similar first,
+        where similarity is `difflib.SequenceMatcher.ratio` and at least `threshold`
+        """
+        query = self.normalise(query)
+        trigrams = get_trigrams(query)
+        shared_counts: Counter[int] = Counter()
+        for trigram in trigrams:
+            shared_counts.update(self.postings.get(trigram, ()))
+
+        # rank by trigram (Dice) similarity, then rescore only the best few exactly
+        candidates = heapq.nlargest(
+            k * RESCORE_FACTOR,
+            shared_counts,
+            key=lambda i: 2
+            * shared_counts[i]
+            / (len(trigrams) + self.trigram_counts[i]),
+        )
+        results = []
+        for i in candidates:
+            similarity = SequenceMatcher(None, query, self.strings[i]).ratio()
+            if similarity >= threshold:
+                results.append((similarity, self.strings[i], self.values[i]))
+        return heapq.nlargest(k, results, key=lambda result: result[0])
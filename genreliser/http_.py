@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Optional
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from genreliser.cache import cached_response
+
+LOGGER = logging.getLogger("genreliser")
+
+USER_AGENT = "genreliser (https://github.com/qwrwed/genreliser)"
+TIMEOUT = 30
+
+# (requests per second, burst size) allowed by each source's provider
+SOURCE_RATE_LIMITS = {
+    "musicbrainz": (1, 1),
+    "acousticbrainz": (1, 10),  # 10 per 10 seconds
+    "acoustid": (3, 3),
+    "github": (60 / 3600, 60),  # unauthenticated
+    "fandom": (5, 5),
+}
+DEFAULT_RATE_LIMIT = (1, 1)
+
+# per-host connections kept alive in each source's session
+POOL_MAXSIZE = 16
+
+RATE_LIMITED_STATUSES = {429, 503}
+# gateway errors, which are usually transient
+RETRIED_STATUSES = {502, 504}
+MAX_ATTEMPTS = 5
+# seconds before the first retry after a connection failure, doubled each time
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+# after being rate limited, the rate is halved, down to this fraction of the limit...
+MIN_RATE_RATIO = 1 / 16
+# ...and raised by this fraction of the limit after each successful request
+RECOVERY_RATE_RATIO = 1 / 10
+
+# failed requests in a row before a source is considered down...
+FAILURE_THRESHOLD = 3
+# ...for this many seconds, doubled each time it's still down when tried again
+COOLDOWN_BASE = 30.0
+COOLDOWN_MAX = 600.0
+
+
+class HostUnavailableError(Exception):
+    """a source couldn't be reached, so anything needing it should be tried later"""
+
+    def __init__(self, source: str, *args) -> None:
+        super().__init__(source, *args)
+        self.source = source
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average, in bursts of up to `capacity`,
+    slowing down when the provider says we're going too fast
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.rate:.3g}/s of {self.max_rate:.3g}/s>"
+
+    def _refill(self, now: float):
+        elapsed = now - max(self.updated_at, min(self.blocked_until, now))
+        self.tokens = min(self.capacity, self.tokens + max(elapsed, 0) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """blocks until a request may be made"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def back_off(self, delay: float):
+        """makes no requests for `delay` seconds, then fewer than before"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.rate / 2, self.max_rate * MIN_RATE_RATIO)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, now + delay)
+
+    def recover(self):
+        if self.rate >= self.max_rate:
+            return
+        with self.lock:
+            self.rate = min(
+                self.max_rate, self.rate + self.max_rate * RECOVERY_RATE_RATIO
+            )
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a source after several fail in a row, until a cooldown has
+    passed; then lets them through again, reopening if they still fail
+    """
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.failures = 0
+        self.cooldown = COOLDOWN_BASE
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.source}' {self.failures=}>"
+
+    def check(self):
+        if (delay := self.open_until - time.monotonic()) > 0:
+            raise HostUnavailableError(
+                self.source, f"{self.source} unavailable for another {delay:.0f}s"
+            )
+
+    def record_success(self):
+        with self.lock:
+            if self.failures >= FAILURE_THRESHOLD:
+                LOGGER.info("%s is available again", self.source)
+            self.failures = 0
+            self.cooldown = COOLDOWN_BASE
+            self.open_until = 0.0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < FAILURE_THRESHOLD:
+                return
+            now = time.monotonic()
+            if self.open_until > now:
+                return  # already opened by another thread
+            LOGGER.warning(
+                "%s unavailable; pausing requests for %.0fs",
+                self.source,
+                self.cooldown,
+            )
+            self.open_until = now + self.cooldown
+            self.cooldown = min(self.cooldown * 2, COOLDOWN_MAX)
+
+
+_buckets: dict[str, TokenBucket] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+_sessions: dict[str, requests.Session] = {}
+_lock = threading.Lock()
+
+
+def get_bucket(source: str) -> TokenBucket:
+    with _lock:
+        if (bucket := _buckets.get(source)) is None:
+            bucket = _buckets[source] = TokenBucket(
+                *SOURCE_RATE_LIMITS.get(source, DEFAULT_RATE_LIMIT)
+            )
+        return bucket
+
+
+def get_breaker(source: str) -> CircuitBreaker:
+    with _lock:
+        if (breaker := _breakers.get(source)) is None:
+            breaker = _breakers[source] = CircuitBreaker(source)
+        return breaker
+
+
+def get_unavailable_delay() -> float:
+    """seconds until every source that's currently down may be tried again"""
+    with _lock:
+        breakers = list(_breakers.values())
+    return max([breaker.open_until - time.monotonic() for breaker in breakers] + [0.0])
+
+
+def get_session(source: str) -> requests.Session:
+    """a keep-alive session per source, shared between threads"""
+    with _lock:
+        if (session := _sessions.get(source)) is None:
+            session = _sessions[source] = requests.Session()
+            session.headers["User-Agent"] = USER_AGENT
+            adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        return session
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    """the Retry-After header's delay in seconds, if there is one"""
+    if (retry_after := response.headers.get("Retry-After")) is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt: int) -> float:
+    return min(BACKOFF_BASE * 2**attempt, BACKOFF_MAX) * random.uniform(0.5, 1)
+
+
+def request(source: str, method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Makes a request through `source`'s session and rate limit, retrying with back-off
+    if it fails to connect or the provider responds that it's rate limited.
+    Raises HostUnavailableError if it keeps failing, or the source is already down.
+    """
+    kwargs.setdefault("timeout", TIMEOUT)
+    bucket = get_bucket(source)
+    breaker = get_breaker(source)
+    session = get_session(source)
+    error = None
+    for attempt in range(MAX_ATTEMPTS):
+        breaker.check()
+        bucket.acquire()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            error = exc
+            delay = get_backoff(attempt)
+            LOGGER.warning(
+                "%s request failed; retrying in %.1fs: %s", source, delay, exc
+            )
+            time.sleep(delay)
+            continue
+        if response.status_code in RATE_LIMITED_STATUSES:
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = get_backoff(attempt)
+            LOGGER.warning(
+                "%s responded %s; waiting %.1fs", source, response.status_code, delay
+            )
+            bucket.back_off(delay)
+            continue
+        if response.status_code in RETRIED_STATUSES:
+            delay = get_backoff(attempt)
+            LOGGER.warning(
+                "%s responded %s; retrying in %.1fs",
+                source,
+                response.status_code,
+                delay,
+            )
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        bucket.recover()
+        return response
+    breaker.record_failure()
+    raise HostUnavailableError(
+        source, f"{method} {url} failed after {MAX_ATTEMPTS} attempts"
+    ) from error
+
+
+def request_json(source: str, method: str, url: str, **kwargs) -> Optional[Any]:
+    """the response's JSON, or None if the request failed"""
+    response = request(source, method, url, **kwargs)
+    if not response.ok:
+        LOGGER.warning(
+            "%s %s responded %s: %s",
+            method,
+            response.url,
+            response.status_code,
+            response.text[:200],
+        )
+        return None
+    return response.json()
+
+
+def get_json(url: str, src_key: str, params: Optional[dict[str, Any]] = None):
+    """GETs JSON from `url` as `src_key`, with responses cached on disk"""
+    if params:
+        url = f"{url}?{urlencode(params)}"
+    return cached_response(
+        src_key, url, None, lambda: request_json(src_key, "GET", url)
+    )
+
+
+def post_json(url: str, src_key: str, data: dict[str, Any]):
+    """POSTs a form to `url` as `src_key`, returning the response's JSON (uncached)"""
+    return request_json(src_key, "POST", url, data=data)
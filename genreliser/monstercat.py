@@ -1,20 +1,47 @@
 from __future__ import annotations
 
+import json
 import logging
 import re
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from difflib import SequenceMatcher
-from functools import cache, cached_property
+from functools import cache, partial
+from itertools import islice
 from pathlib import Path
 from pprint import pformat
+from typing import Callable, Optional
 from urllib.parse import quote
 
 import fandom
-from fandom.error import PageError
-from utils_python import copy_signature, deduplicate, flatten, print_tqdm
+import requests
+from utils_python import (
+    copy_signature,
+    deduplicate,
+    ensure_caps,
+    flatten,
+    print_tqdm,
+)
 
 from genreliser.base import LOGGER, BaseGenreliser, MusicFile
-from genreliser.fandom_ import EnhancedFandomPage
-from genreliser.utils import ensure_one
+from genreliser.cache import cache_miss, is_cached_miss
+from genreliser.fandom_ import (
+    EnhancedFandomPage,
+    WikiClient,
+    get_latest_revisions,
+    query_pages,
+    search,
+)
+from genreliser.fuzzy import TrigramIndex
+from genreliser.store import normalise_path
+from genreliser.utils import cached_property, ensure_one, with_thread_log_prefix
+from genreliser.wiki_index import (
+    IndexRecord,
+    WikiIndex,
+    iter_records_from_release,
+    normalise_title,
+)
 
 print_std = print
 print = print_tqdm
@@ -34,8 +61,21 @@ PATTERN_FEAT_FROM_TITLE = r"( \(?feat\.? [\w\s]+)\)?"
 PATTERN_FEAT_FROM_ARTIST = r"( feat\.? [\w\s]+)"
 # TODO: merge feat patterns?
 
+MONSTERCAT_WIKI = "monstercat"
+
 WIKI_SEARCH_MATCH_RESULTS = 20
 
+# title variants explored at once, shared between all files being processed
+VARIANT_WORKERS = 8
+_variant_executor = ThreadPoolExecutor(
+    max_workers=VARIANT_WORKERS, thread_name_prefix="variant"
+)
+
+# files from the same release needing the wiki before its page is looked up
+MIN_RELEASE_FILES = 2
+# songs linked from a page beyond which it's not treated as a release's tracklist
+MAX_RELEASE_SONGS = 100
+
 
 class WikiPageNotFoundError(Exception):
     ...
@@ -45,9 +85,10 @@ class MultipleResultsError(Exception):
     ...
 
 
-def log_monstercat_search_string(query):
+def log_monstercat_search_string(client: WikiClient, query):
     LOGGER.info(
-        "search query = 'https://monstercat.fandom.com/wiki/Special:Search?query=%s'",
+        "search query = 'https://%s.fandom.com/wiki/Special:Search?query=%s'",
+        client.wiki,
         quote(query),
     )
 
@@ -58,44 +99,176 @@ CHAR_DIFFERENCE_THRESHOLD = 3
 SearchResult = tuple[str, int]
 
 
-def get_wiki_page(page: str | int | fandom.FandomPage):
+def get_page_type(categories: list[str], is_disambiguation: bool) -> str:
+    if is_disambiguation:
+        return "disambiguation"
+    elif "Songs" in categories:
+        return "song"
+    return "unknown"
+
+
+class MonstercatWikiPage(EnhancedFandomPage):
+    def extract_record(self, html: str, soup) -> dict:
+        record = super().extract_record(html, soup)
+        record["is_disambiguation"] = "disambiguation" in html
+        record["titles"] = get_titles_from_monstercat_soup(soup)
+        record["genres"] = get_genres_from_monstercat_soup(soup)
+        return record
+
+
+def get_wiki_page_from_index_record(
+    record: IndexRecord, client: WikiClient
+) -> MonstercatWikiPage:
+    return MonstercatWikiPage.from_record(
+        record["pageid"],
+        record["title"],
+        record["url"],
+        {
+            "categories": ["Songs"],
+            "is_disambiguation": False,
+            "titles": [record["name"]],
+            "genres": record["genres"],
+        },
+        client,
+        revid=record["revid"],
+    )
+
+
+WikiResolution = dict  # {"pageid": int, "revid": int, "title", "url", "record"}
+
+
+def get_wiki_resolution(page: MonstercatWikiPage) -> WikiResolution:
+    return {
+        "pageid": page.pageid,
+        "revid": getattr(page, "revid", None),
+        "title": page.title,
+        "url": page.url,
+        "record": page.record,
+    }
+
+
+def get_wiki_page_from_resolution(
+    resolution: WikiResolution, client: WikiClient
+) -> MonstercatWikiPage:
+    return MonstercatWikiPage.from_record(
+        resolution["pageid"],
+        resolution["title"],
+        resolution["url"],
+        resolution["record"],
+        client,
+        revid=resolution["revid"],
+    )
+
+
+def get_resolution_key(titles: list[str], disambiguators: list[str]) -> str:
+    return json.dumps([titles, disambiguators], ensure_ascii=False)
+
+
+def get_wiki_page(
+    page: str | int | fandom.FandomPage, client: Optional[WikiClient]
+) -> MonstercatWikiPage:
+    """`client` is only needed if `page` is an identifier"""
     if isinstance(page, (str, int)):
-        return EnhancedFandomPage(page)
-    elif isinstance(page, EnhancedFandomPage):
+        return MonstercatWikiPage(page, client)
+    elif isinstance(page, MonstercatWikiPage):
         return page
     raise TypeError(f"Cannot get FandomPage from {page}")
 
 
+PageClassification = dict  # {"pageid": int, "title": str, "type": str}
+
+
+def classify_pages(
+    client: WikiClient, pageids: list[int] = (), titles: list[str] = ()
+) -> dict[int | str, PageClassification | None]:
+    """
+    Classifies many pages using only their categories and page props, without loading
+    or parsing their html. Returns a classification (or None if there is no such page)
+    for each pageid and title given.
+    """
+    # also try the capitalised title, as EnhancedFandomPage does
+    titles_capitalised = {title: ensure_caps(title) for title in titles}
+    pages, resolved_titles = query_pages(
+        client,
+        pageids=pageids,
+        titles=[*titles, *titles_capitalised.values()],
+        params={
+            "prop": "categories|pageprops",
+            "cllimit": "max",
+            "ppprop": "disambiguation",
+        },
+    )
+
+    classifications: dict[int, PageClassification] = {}
+    for page in pages.values():
+        if "missing" in page or "invalid" in page:
+            continue
+        categories = [
+            category["title"].split(":", 1)[-1]
+            for category in page.get("categories", [])
+        ]
+        is_disambiguation = "disambiguation" in page.get("pageprops", {}) or any(
+            "disambiguation" in category.lower() for category in categories
+        )
+        classifications[page["pageid"]] = {
+            "pageid": page["pageid"],
+            "title": page["title"],
+            "type": get_page_type(categories, is_disambiguation),
+        }
+
+    def classify_title(title: str):
+        page = pages.get(resolved_titles.get(title, title), {})
+        return classifications.get(page.get("pageid"))
+
+    results: dict[int | str, PageClassification | None] = {
+        pageid: classifications.get(pageid) for pageid in pageids
+    }
+    for title in titles:
+        results[title] = classify_title(title) or classify_title(
+            titles_capitalised[title]
+        )
+    return results
+
+
 class MonstercatWikiPageInfo(dict):
     ignored_equality_keys = {"query", "query_similarity"}
 
     def __init__(
-        self, page: str | int | fandom.FandomPage, search_query: str | None = None
+        self,
+        page: str | int | fandom.FandomPage,
+        search_query: str | None = None,
+        page_type: str | None = None,
+        title: str | None = None,
+        query_similarity: float | None = None,
+        client: WikiClient | None = None,
     ) -> None:
-        page = get_wiki_page(page)
+        """
+        If `page_type` and `title` are given (e.g. from `classify_pages`), `page` can be
+        an identifier and won't be loaded; otherwise the page is loaded (from `client`,
+        if it's an identifier) and classified.
+        `query_similarity` can be given if already known (e.g. from a title index).
+        """
+        if page_type is None or title is None:
+            page = get_wiki_page(page, client)
+            title = page.title
+            page_type = get_page_type(
+                page.record["categories"], page.record["is_disambiguation"]
+            )
+
         __normalize = lambda s: s.replace('"', "").lower()
         if search_query is None:
             query_similarity = None
-        else:
+        elif query_similarity is None:
             query_similarity = SequenceMatcher(
-                None, __normalize(search_query), __normalize(page.title)
+                None, __normalize(search_query), __normalize(title)
             ).ratio()
 
-        if "disambiguation" in page.html:
-            page_type = "disambiguation"
-        else:
-            if page.soup.find_all(
-                "li", {"class": "category normal", "data-name": "Songs"}
-            ):
-                page_type = "song"
-            else:
-                page_type = "unknown"
-
         is_exact_match = query_similarity in {None, 1.0}
 
         super().__init__(
             {
                 "page": page,
+                "title": title,
                 "query": search_query,
                 "query_similarity": query_similarity,
                 "type": page_type,
@@ -103,6 +276,17 @@ class MonstercatWikiPageInfo(dict):
             }
         )
 
+    @classmethod
+    def from_classification(
+        cls, classification: PageClassification, search_query: str | None = None
+    ):
+        return cls(
+            classification["pageid"],
+            search_query=search_query,
+            page_type=classification["type"],
+            title=classification["title"],
+        )
+
     def __eq__(self, __value: object) -> bool:
         if isinstance(__value, self.__class__):
             self_without_ignored_keys = {
@@ -130,65 +314,185 @@ class MonstercatWikiPageInfo(dict):
         return hash(self["id"])
 
 
+@cache
+def build_title_index(client: WikiClient) -> TrigramIndex[IndexRecord]:
+    """a trigram index of the titles in the client's wiki index, built once"""
+    title_index: TrigramIndex[IndexRecord] = TrigramIndex(normalise=normalise_title)
+    records_titles = [
+        (
+            record,
+            deduplicate(map(normalise_title, [record["title"], *record["aliases"]])),
+        )
+        for record in client.index.records()
+    ]
+    title_counts = Counter(
+        title for _record, titles in records_titles for title in titles
+    )
+    for record, titles in records_titles:
+        for title in titles:
+            # a base title shared by several pages (e.g. "Alive") identifies none
+            if title_counts[title] == 1 or title == normalise_title(record["title"]):
+                title_index.add(title, record)
+    LOGGER.info("built title index of %s titles", len(title_index))
+    return title_index
+
+
+def search_title_index(client: WikiClient, query: str) -> list[MonstercatWikiPageInfo]:
+    """
+    Returns pages from the wiki index with a title or alias similar to `query`
+    (above SIMILARITY_THRESHOLD), without searching the wiki, best first by that
+    similarity; aliases shared by several pages aren't matched, so a page that only
+    shares its base title with others (e.g. "Alive (Artist)") isn't
+    """
+    if client.index is None:
+        return []
+    page_infos: dict[int, MonstercatWikiPageInfo] = {}
+    for similarity, _title, record in build_title_index(client).query(
+        query, k=WIKI_SEARCH_MATCH_RESULTS, threshold=SIMILARITY_THRESHOLD
+    ):
+        if record["pageid"] in page_infos:
+            continue
+        page_infos[record["pageid"]] = MonstercatWikiPageInfo(
+            get_wiki_page_from_index_record(record, client),
+            search_query=query,
+            page_type="song",
+            title=record["title"],
+            query_similarity=similarity,
+        )
+    return sorted(page_infos.values(), reverse=True)
+
+
+def explore_title_variant(
+    client: WikiClient,
+    title_searched: str,
+    classifications: dict[str, PageClassification | None],
+    stop: threading.Event,
+) -> tuple[list[MonstercatWikiPageInfo], bool]:
+    """
+    Returns the pages found for one variant of a title, and whether the first is an
+    exact match (in which case it's the only one); similar titles in the wiki index
+    are used instead of searching the wiki, if there are any.
+    Nothing more is requested once `stop` is set (e.g. as a preferred variant has
+    been matched exactly).
+    """
+    if (classification := classifications.get(title_searched)) is not None:
+        return [MonstercatWikiPageInfo.from_classification(classification)], False
+    if page_infos := search_title_index(client, title_searched):
+        exact_matches = [
+            page_info for page_info in page_infos if page_info["is_exact_match"]
+        ]
+        if len(exact_matches) == 1:
+            return exact_matches, True
+        return page_infos, False
+
+    search_descriptor = client.get_descriptor(title_searched)
+    if is_cached_miss("fandom_no_song_results", search_descriptor):
+        LOGGER.info("Skipping search %r; recently found no songs", title_searched)
+        return [], False
+    if stop.is_set():
+        return [], False
+    log_monstercat_search_string(client, title_searched)
+    search_results: list[SearchResult] = search(client, title_searched)
+    if stop.is_set():
+        return [], False
+    search_classifications = classify_pages(
+        client, pageids=[page_id for _title, page_id in search_results]
+    )
+    page_infos = []
+    found_song = False
+    for _title, page_id in search_results:
+        if (classification := search_classifications[page_id]) is None:
+            continue
+        page_info = MonstercatWikiPageInfo.from_classification(
+            classification, search_query=title_searched
+        )
+        if page_info["type"] == "song":
+            found_song = True
+            if page_info["is_exact_match"]:
+                return [page_info], True
+            page_infos.append(page_info)
+    if not found_song:
+        cache_miss("fandom_no_song_results", search_descriptor)
+    return page_infos, False
+
+
 def get_all_pages_from_title(
-    title: str, disambiguators: list[str]
+    client: WikiClient, title: str, disambiguators: list[str]
 ) -> list[MonstercatWikiPageInfo]:
-    fandom.set_wiki("Monstercat")
-
     titles_to_search = [
         f"{title} ({disambiguator})" for disambiguator in disambiguators
     ]
 
     page_infos: list[MonstercatWikiPageInfo] = []
 
-    try:
-        page = EnhancedFandomPage(title)
-        page_info = MonstercatWikiPageInfo(page)
+    # classify the title and all its disambiguated variants in one request
+    classifications = classify_pages(client, titles=[title, *titles_to_search])
+
+    if (classification := classifications[title]) is not None:
+        page_info = MonstercatWikiPageInfo.from_classification(classification)
         if page_info["type"] == "song":
             return [page_info]
         elif page_info["type"] == "disambiguation":
             LOGGER.info("Found disambiguation page; will search with disambiguators")
         else:
             LOGGER.warning(
-                "Found unknown page type %s; including in results anyway.", page.url
+                "Found unknown page type %s; including in results anyway.",
+                page_info["title"],
             )
             page_infos.append(page_info)
-    except PageError:
+    else:
         LOGGER.info(
             "Did not find page; will search for title, then search with disambiguators"
         )
         titles_to_search.insert(0, f'"{title}"')
         titles_to_search.insert(0, f"{title}")
 
-    for title_searched in titles_to_search:
-        try:
-            page = EnhancedFandomPage(title_searched)
-            page_infos.append(MonstercatWikiPageInfo(page))
-        except PageError:
-            log_monstercat_search_string(title_searched)
-            search_results: list[SearchResult] = fandom.search(title_searched)
-            # TODO: retry if network failure:
-            # socket.gaierror: [Errno -3] Temporary failure in name resolution
-            # requests.exceptions.ConnectionError: HTTPSConnectionPool(host='monstercat.fandom.com', port=443): Max retries exceeded with url: /en/api.php?action=query&srlimit=10&list=search&srsearch=Just+Dance+%28Pegboard+Nerds%29&format=json (Caused by NameResolutionError("<urllib3.connection.HTTPSConnection object at 0xeaca9a90>: Failed to resolve 'monstercat.fandom.com' ([Errno -3] Temporary failure in name resolution)"))
-            for _title, page_id in search_results:
-                page_info = MonstercatWikiPageInfo(page_id, search_query=title_searched)
-                if page_info["type"] == "song":
-                    if page_info["is_exact_match"]:
-                        return [page_info]
-                    page_infos.append(page_info)
+    # explore the variants concurrently, but in order of preference; once one is
+    #  matched exactly, less preferred ones stop making requests
+    explore_variant = with_thread_log_prefix(LOGGER, explore_title_variant)
+    stops = [threading.Event() for _title in titles_to_search]
+
+    def stop_less_preferred(i: int, future: Future):
+        if not future.cancelled() and not future.exception() and future.result()[1]:
+            for stop in stops[i + 1 :]:
+                stop.set()
+
+    futures = []
+    for i, (title_searched, stop) in enumerate(zip(titles_to_search, stops)):
+        future = _variant_executor.submit(
+            explore_variant, client, title_searched, classifications, stop
+        )
+        future.add_done_callback(partial(stop_less_preferred, i))
+        futures.append(future)
+    try:
+        for future in futures:
+            variant_page_infos, is_exact_match = future.result()
+            if is_exact_match:
+                return variant_page_infos
+            page_infos.extend(variant_page_infos)
+    finally:
+        for future, stop in zip(futures, stops):
+            stop.set()
+            future.cancel()
 
     return page_infos
 
 
 def get_page_from_titles(
-    titles: list[str], disambiguators: list[str]
-) -> EnhancedFandomPage:
+    client: WikiClient, titles: list[str], disambiguators: list[str]
+) -> tuple[MonstercatWikiPage, bool]:
     """
-    Returns the closest page match given a list of possible titles and disambiguators
+    Returns the closest page match given a list of possible titles and disambiguators,
+    and whether it's an exact match
     """
     LOGGER.info("Finding page for titles=%s, disambiguators=%s", titles, disambiguators)
     page_infos = sorted(
-        flatten([get_all_pages_from_title(title, disambiguators) for title in titles]),
+        flatten(
+            [
+                get_all_pages_from_title(client, title, disambiguators)
+                for title in titles
+            ]
+        ),
         reverse=True,
     )
     if len(page_infos) == 0:
@@ -204,19 +508,18 @@ def get_page_from_titles(
     match_type = "exact" if page_info["is_exact_match"] else "best"
     LOGGER.info("Found %s match: %s", match_type, page_info)
 
-    return page_info["page"]
+    # only the winning page is loaded in full
+    return get_wiki_page(page_info["page"], client), page_info["is_exact_match"]
 
 
-def get_page_from_known_fields(
+def get_disambiguators(
     known_fields: dict[str, list[str] | dict[str, list[str]]]
-) -> EnhancedFandomPage:
-    fandom.set_wiki("Monstercat")
-    titles = known_fields["titles"]
+) -> list[str]:
     try:
         artist = ensure_one(known_fields.get("artists", []), allow_zero=True)
     except NotImplementedError as exc:
-        breakpoint()
-        pass
+        LOGGER.warning("not disambiguating by artist; %s", exc)
+        artist = None
     disambiguators = []
     include_artist = True
     for extras_key, extras_values in known_fields["extras"].items():
@@ -227,15 +530,49 @@ def get_page_from_known_fields(
         )
     if artist and include_artist:
         disambiguators.append(artist)
+    return disambiguators
+
+
+def lookup_titles(
+    wiki_index: WikiIndex, titles: list[str], disambiguators: list[str]
+) -> Optional[IndexRecord]:
+    for title in titles:
+        if (record := wiki_index.lookup(title, disambiguators)) is not None:
+            return record
+    return None
 
-    page = get_page_from_titles(titles, disambiguators)
-    return page
 
+def get_page_from_known_fields(
+    client: WikiClient,
+    known_fields: dict[str, list[str] | dict[str, list[str]]],
+    get_release_index: Callable[[], Optional[WikiIndex]] = lambda: None,
+) -> tuple[MonstercatWikiPage, bool]:
+    """
+    Returns the page for the fields, and whether it's an exact match (as it always is
+    from an index); `get_release_index` returns the songs of the release the file is
+    from, if they're known or worth looking up, and is only called if the wiki index
+    doesn't have the page
+    """
+    titles = known_fields["titles"]
+    disambiguators = get_disambiguators(known_fields)
+
+    if client.index is not None:
+        if record := lookup_titles(client.index, titles, disambiguators):
+            LOGGER.info("Found page in wiki index: %s", record["url"])
+            return get_wiki_page_from_index_record(record, client), True
+
+    if (release_index := get_release_index()) is not None:
+        if record := lookup_titles(release_index, titles, disambiguators):
+            LOGGER.info("Found page in release's songs: %s", record["url"])
+            return get_wiki_page_from_index_record(record, client), True
+
+    LOGGER.info("No unambiguous page in wiki index or release's songs; searching wiki")
+    return get_page_from_titles(client, titles, disambiguators)
 
-# @cache
-def get_genres_from_monstercat_page(page: EnhancedFandomPage):
+
+def get_genres_from_monstercat_soup(soup) -> list[str]:
     genres_found = []
-    for genre_section_soup in page.soup.find_all(
+    for genre_section_soup in soup.find_all(
         "div", {"data-source": re.compile(".*[gG]enre.*")}
     ):
         for genre_soup in genre_section_soup.find_all("a"):
@@ -245,31 +582,36 @@ def get_genres_from_monstercat_page(page: EnhancedFandomPage):
     return deduplicate(genres_found)
 
 
-# @cache
-def get_titles_from_monstercat_page(page: EnhancedFandomPage):
+def get_titles_from_monstercat_soup(soup) -> list[str]:
     results = []
-    for sub_soup in page.soup.find_all(attrs={"data-source": "Name"}):
+    for sub_soup in soup.find_all(attrs={"data-source": "Name"}):
         for content in sub_soup.contents:
             if content not in results:
                 if isinstance(content, str):
-                    results.append(content)
+                    results.append(str(content))
     if len(results) > 1:
         LOGGER.warning("multiple titles found on wiki: %s", results)
         results = ["".join(results)]
     return results
 
 
-def get_artists_from_monstercat_page(page: EnhancedFandomPage):
+def get_genres_from_monstercat_page(page: MonstercatWikiPage):
+    return page.record["genres"]
+
+
+def get_titles_from_monstercat_page(page: MonstercatWikiPage):
+    return page.record["titles"]
+
+
+def get_artists_from_monstercat_page(page: MonstercatWikiPage):
     raise NotImplementedError
 
 
-def get_albums_from_monstercat_page(page: EnhancedFandomPage):
+def get_albums_from_monstercat_page(page: MonstercatWikiPage):
     raise NotImplementedError
 
 
-Title = str
-Artist = str
-Url = str
+ResolutionKey = str  # JSON of [titles, disambiguators]
 
 
 class MonstercatGenreliser(BaseGenreliser):
@@ -279,10 +621,143 @@ class MonstercatGenreliser(BaseGenreliser):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.music_file_type = MonstercatMusicFile
-        self.wiki_resolutions = {}  # type: dict[tuple[Title, Artist], Url]
+        self.wiki_client = WikiClient(MONSTERCAT_WIKI)
+        # pages previously found for the same fields, from any file (or any run, if
+        #  an exact match)
+        self.wiki_resolutions: dict[
+            ResolutionKey, WikiResolution
+        ] = self.store.get_wiki_resolutions()
+        # songs linked from each release's page (None if unusable, so it's not
+        #  looked up again), by album, and how many files from each have needed
+        #  the wiki; see `get_release_index`
+        self.release_indexes: dict[str, Optional[WikiIndex]] = {}
+        self.release_file_counts: Counter[str] = Counter()
+        self.release_locks: dict[str, threading.Lock] = {}
+        self.releases_lock = threading.Lock()
+
+    def get_release_index(self, release_title: Optional[str]) -> Optional[WikiIndex]:
+        """
+        The songs linked from the page of a release (e.g. its tracklist), looked up
+        once MIN_RELEASE_FILES files from it have needed the wiki, in a few batched
+        requests, so later files' pages can be found among them instead of searched
+        for; None if the release is unknown or its page unusable
+        """
+        if release_title is None:
+            return None
+        with self.releases_lock:
+            self.release_file_counts[release_title] += 1
+            if self.release_file_counts[release_title] < MIN_RELEASE_FILES:
+                return None
+            release_lock = self.release_locks.setdefault(
+                release_title, threading.Lock()
+            )
+        # other files from the release wait for its songs, rather than search
+        with release_lock:
+            if release_title not in self.release_indexes:
+                self.release_indexes[release_title] = self.lookup_release(release_title)
+            return self.release_indexes[release_title]
+
+    def lookup_release(self, release_title: str) -> Optional[WikiIndex]:
+        LOGGER.info("Looking up songs of release %r", release_title)
+        try:
+            records = list(
+                islice(
+                    iter_records_from_release(self.wiki_client, release_title),
+                    MAX_RELEASE_SONGS + 1,
+                )
+            )
+        except requests.HTTPError as exc:
+            LOGGER.warning("Couldn't look up release %r: %s", release_title, exc)
+            return None
+        if not records or len(records) > MAX_RELEASE_SONGS:
+            LOGGER.info("Not using release %r; %s songs", release_title, len(records))
+            return None
+        release_index = WikiIndex(Path(":memory:"))
+        release_index.add_pages(records)
+        return release_index
+
+    def get_page_from_known_fields(
+        self,
+        known_fields: dict[str, list[str]],
+        release_title: Optional[str] = None,
+    ) -> MonstercatWikiPage:
+        """
+        get_page_from_known_fields, remembering the page found for the fields; only
+        exact matches are kept for later runs, as a better match for the others may
+        be added to the wiki. `release_title` is the file's album, if tagged.
+        """
+        key = get_resolution_key(
+            known_fields["titles"], get_disambiguators(known_fields)
+        )
+        if (resolution := self.wiki_resolutions.get(key)) is not None:
+            LOGGER.info("Using previously found page: %s", resolution["url"])
+            return get_wiki_page_from_resolution(resolution, self.wiki_client)
+        page, is_exact_match = get_page_from_known_fields(
+            self.wiki_client,
+            known_fields,
+            partial(self.get_release_index, release_title),
+        )
+        resolution = get_wiki_resolution(page)
+        self.wiki_resolutions[key] = resolution
+        if is_exact_match:
+            self.store.set_wiki_resolution(key, resolution)
+        return page
+
+    def refresh_wiki_resolutions(self) -> list[Path]:
+        """
+        Re-extracts previously found pages whose revision has changed (checking
+        revision ids only), returning the files whose results came from a changed
+        page; these won't be skipped as unchanged
+        """
+        keys_by_pageid: dict[int, list[ResolutionKey]] = {}
+        for key, resolution in self.wiki_resolutions.items():
+            keys_by_pageid.setdefault(resolution["pageid"], []).append(key)
+        LOGGER.info("checking %s wiki pages for new revisions", len(keys_by_pageid))
+        latest_revisions = get_latest_revisions(self.wiki_client, keys_by_pageid)
+
+        stale_urls = set()
+        keys_removed = []
+        for pageid, keys in keys_by_pageid.items():
+            resolution = self.wiki_resolutions[keys[0]]
+            if pageid not in latest_revisions:
+                stale_urls.add(resolution["url"])
+                keys_removed.extend(keys)
+                continue
+            revid, title = latest_revisions[pageid]
+            if revid == resolution["revid"]:
+                continue
+            stale_urls.add(resolution["url"])
+            page = MonstercatWikiPage.from_record(
+                pageid,
+                title,
+                self.wiki_client.get_page_url(title),
+                None,
+                self.wiki_client,
+                revid=revid,
+            )
+            resolution = get_wiki_resolution(page)
+            for key in keys:
+                self.wiki_resolutions[key] = resolution
+                self.store.set_wiki_resolution(key, resolution)
+        for key in keys_removed:
+            del self.wiki_resolutions[key]
+        self.store.delete_wiki_resolutions(keys_removed)
+
+        stale_paths = self.store.get_paths_with_extra("wiki_url", stale_urls)
+        self.stale_paths.update(normalise_path(path) for path in stale_paths)
+        LOGGER.info(
+            "%s wiki pages changed, affecting %s files",
+            len(stale_urls),
+            len(stale_paths),
+        )
+        return stale_paths
 
-    def get_fields_from_monstercat_wiki(self, known_fields: dict[str, list[str]]):
-        page = get_page_from_known_fields(known_fields)
+    def get_fields_from_monstercat_wiki(
+        self,
+        known_fields: dict[str, list[str]],
+        release_title: Optional[str] = None,
+    ):
+        page = self.get_page_from_known_fields(known_fields, release_title)
         fields = {
             "titles": get_titles_from_monstercat_page(page),
             "genres": get_genres_from_monstercat_page(page),
@@ -301,22 +776,31 @@ GENRE_EXCLUSIONS = {"dance", "monstercat", "monsterccat"}
 
 
 class MonstercatMusicFile(MusicFile[MonstercatGenreliser]):
+    # the wiki is searched by the titles (and artists) from the filename
+    source_dependencies = {"wiki": {"title"}}
+    default_sources = [*MusicFile.default_sources, "wiki"]
+
     def __init__(self, filepath: Path, genreliser: MonstercatGenreliser) -> None:
         super().__init__(filepath, genreliser)
-        self.sources.append("wiki")
         self.genre_exclusions.update(GENRE_EXCLUSIONS)
 
     @cached_property
     def fields_from_wiki(self):
-        fields_combined = self.fields_combined
+        # only from its dependencies, which have been fetched by now
+        fields_combined = self.get_fields_combined(self.source_dependencies["wiki"])
         for required_field in ["titles"]:
             if required_field not in fields_combined:
                 raise ValueError(f"{required_field=} missing from {fields_combined=}")
-        return self.genreliser.get_fields_from_monstercat_wiki(fields_combined)
+        return self.genreliser.get_fields_from_monstercat_wiki(
+            fields_combined, self.tag_album
+        )
 
     def get_fields_from_sources(self):
         """generates fields, removing titles from tag if not also from wiki"""
         fields = super().get_fields_from_sources()
+        if "fields_from_wiki" not in self.__dict__:
+            # skipped, as cheaper sources were enough
+            return fields
 
         # trust the wiki over the title tag:
         #  remove any song titles from the title tag that aren't in the wiki
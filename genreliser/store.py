@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Literal, NamedTuple, Optional
+
+from genreliser.utils import connect_sqlite
+
+LOGGER = logging.getLogger("genreliser")
+
+DEFAULT_RESULTS_PATH = Path("data/results.sqlite")
+
+Status = Literal["passed", "failed"]
+Retry = Literal["failed", "passed", "all"]
+
+RETRIED_STATUSES: dict[Retry | None, set[Status]] = {
+    None: set(),
+    "failed": {"failed"},
+    "passed": {"passed"},
+    "all": {"failed", "passed"},
+}
+
+
+def normalise_path(path: Path | str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def get_skipped_statuses(retry: Retry | None) -> list[Status]:
+    return sorted({"failed", "passed"} - RETRIED_STATUSES[retry])
+
+
+class ManifestEntry(NamedTuple):
+    """what a file looked like when its result was recorded"""
+
+    status: Status
+    size: Optional[int]
+    mtime_ns: Optional[int]
+    content_hash: Optional[str]
+
+
+def get_skip_reason(
+    entry: Optional[ManifestEntry],
+    stat: os.stat_result,
+    retry: Retry | None,
+    get_content_hash: Optional[Callable[[], str]] = None,
+) -> Optional[str]:
+    """
+    Returns why a file with this manifest entry and current `stat` shouldn't be
+    processed again, or None if it should be (i.e. it's new, changed, or retried).
+    If `get_content_hash` is given, files whose size is unchanged but mtime isn't
+    are compared by content.
+    """
+    if entry is None or entry.status not in get_skipped_statuses(retry):
+        return None
+    if entry.size is None:
+        # imported from an older version, so we don't know what it looked like
+        return f"already {entry.status} and retry={retry}"
+    if entry.size != stat.st_size:
+        return None
+    if entry.mtime_ns != stat.st_mtime_ns and (
+        get_content_hash is None
+        or entry.content_hash is None
+        or entry.content_hash != get_content_hash()
+    ):
+        return None
+    return f"already {entry.status}, unchanged, and retry={retry}"
+
+
+class ResultStore:
+    """
+    SQLite-backed record of each file's outcome (and fields, if it passed),
+    keyed by normalised path, along with a manifest of what the file looked like
+    """
+
+    def __init__(self, path: Path = DEFAULT_RESULTS_PATH, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        self.connection = connect_sqlite(self.path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT PRIMARY KEY,
+                status TEXT NOT NULL CHECK (status IN ('passed', 'failed')),
+                fields TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_status ON results (status);
+            CREATE TABLE IF NOT EXISTS wiki_resolutions (
+                key TEXT PRIMARY KEY,
+                resolution TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            """
+        )
+        columns = {
+            name
+            for _cid, name, *_ in self.connection.execute("PRAGMA table_info(results)")
+        }
+        # manifest columns, added after the table was first released
+        for column in ["size INTEGER", "mtime_ns INTEGER", "content_hash TEXT"]:
+            if column.split()[0] not in columns:
+                self.connection.execute(f"ALTER TABLE results ADD COLUMN {column}")
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.path}'>"
+
+    def count(self, status: Optional[Status] = None) -> int:
+        with self.lock:
+            if status is None:
+                query = self.connection.execute("SELECT COUNT(*) FROM results")
+            else:
+                query = self.connection.execute(
+                    "SELECT COUNT(*) FROM results WHERE status = ?", (status,)
+                )
+            return query.fetchone()[0]
+
+    def get_status(self, filepath: Path | str) -> Optional[Status]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM results WHERE path = ?", (normalise_path(filepath),)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def get_manifest_entry(self, filepath: Path | str) -> Optional[ManifestEntry]:
+        with self.lock:
+            row = self.connection.execute(
+                """
+                SELECT status, size, mtime_ns, content_hash FROM results
+                WHERE path = ?
+                """,
+                (normalise_path(filepath),),
+            ).fetchone()
+        return None if row is None else ManifestEntry(*row)
+
+    def get_manifest(self) -> dict[str, ManifestEntry]:
+        """every file's manifest entry, by normalised path, for bulk change detection"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, status, size, mtime_ns, content_hash FROM results"
+            ).fetchall()
+        return {path: ManifestEntry(*entry) for path, *entry in rows}
+
+    def update_manifest_entry(
+        self,
+        filepath: Path | str,
+        stat: os.stat_result,
+        content_hash: Optional[str] = None,
+    ):
+        """records that a file's new stat still matches its recorded result"""
+        if self.readonly:
+            return
+        with self.lock:
+            self.connection.execute(
+                """
+                UPDATE results SET size = ?, mtime_ns = ?,
+                    content_hash = COALESCE(?, content_hash)
+                WHERE path = ?
+                """,
+                (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    content_hash,
+                    normalise_path(filepath),
+                ),
+            )
+
+    def get_fields(self, filepath: Path | str) -> Optional[dict]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT fields FROM results WHERE path = ? AND status = 'passed'",
+                (normalise_path(filepath),),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_paths(self, statuses: Iterable[Status]) -> list[Path]:
+        statuses = list(statuses)
+        with self.lock:
+            rows = self.connection.execute(
+                f"""
+                SELECT path FROM results
+                WHERE status IN ({", ".join("?" * len(statuses))})
+                ORDER BY path
+                """,
+                statuses,
+            ).fetchall()
+        return [Path(path) for (path,) in rows]
+
+    def set_result(
+        self,
+        filepath: Path | str,
+        status: Status,
+        fields: Optional[dict] = None,
+        stat: Optional[os.stat_result] = None,
+        content_hash: Optional[str] = None,
+    ):
+        if self.readonly:
+            return
+        with self.lock:
+            self.connection.execute(
+                """
+                INSERT OR REPLACE INTO results
+                    (path, status, fields, updated_at, size, mtime_ns, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    normalise_path(filepath),
+                    status,
+                    None if fields is None else json.dumps(fields, default=str),
+                    time.time(),
+                    None if stat is None else stat.st_size,
+                    None if stat is None else stat.st_mtime_ns,
+                    content_hash,
+                ),
+            )
+
+    def get_paths_with_extra(self, key: str, values: Iterable[str]) -> list[Path]:
+        """passed files with any of `values` in their fields' extras[key]"""
+        values = list(values)
+        if not values:
+            return []
+        with self.lock:
+            rows = self.connection.execute(
+                f"""
+                SELECT DISTINCT results.path
+                FROM results, json_each(results.fields, ?) AS extra
+                WHERE results.status = 'passed'
+                    AND extra.value IN ({", ".join("?" * len(values))})
+                ORDER BY results.path
+                """,
+                [f'$.extras."{key}"', *values],
+            ).fetchall()
+        return [Path(path) for (path,) in rows]
+
+    def set_passed(self, filepath: Path | str, fields: dict, **manifest_kwargs):
+        self.set_result(filepath, "passed", fields, **manifest_kwargs)
+
+    def set_failed(self, filepath: Path | str, **manifest_kwargs):
+        self.set_result(filepath, "failed", **manifest_kwargs)
+
+    def import_results(
+        self, json_data: dict[Path | str, dict], failed_files: Iterable[Path | str]
+    ):
+        """
+        imports results from the previous data_*.json/failed_*.json format,
+        for files not already in the store (whose results are newer)
+        """
+        if self.readonly:
+            return
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            # passed first, so a file in both files isn't imported as failed
+            self.connection.executemany(
+                """
+                INSERT OR IGNORE INTO results (path, status, fields, updated_at)
+                VALUES (?, 'passed', ?, ?)
+                """,
+                [
+                    (normalise_path(filepath), json.dumps(fields, default=str), now)
+                    for filepath, fields in json_data.items()
+                ],
+            )
+            self.connection.executemany(
+                """
+                INSERT OR IGNORE INTO results (path, status, fields, updated_at)
+                VALUES (?, 'failed', NULL, ?)
+                """,
+                [(normalise_path(filepath), now) for filepath in failed_files],
+            )
+
+    def export_json_data(self) -> dict[str, dict]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, fields FROM results WHERE status = 'passed' ORDER BY path"
+            ).fetchall()
+        return {path: json.loads(fields) for path, fields in rows}
+
+    def export_json(self, path: Path):
+        """writes `export_json_data` to `path`, replacing any previous export whole"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+            json.dump(self.export_json_data(), tmp_file, indent=4, default=str)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+
+    def get_wiki_resolutions(self) -> dict[str, dict]:
+        """every wiki page previously resolved from a file's fields, by key"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, resolution FROM wiki_resolutions"
+            ).fetchall()
+        return {key: json.loads(resolution) for key, resolution in rows}
+
+    def set_wiki_resolution(self, key: str, resolution: dict):
+        if self.readonly:
+            return
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO wiki_resolutions VALUES (?, ?, ?)",
+                (key, json.dumps(resolution, default=str), time.time()),
+            )
+
+    def delete_wiki_resolutions(self, keys: Iterable[str]):
+        if self.readonly:
+            return
+        with self.lock:
+            self.connection.executemany(
+                "DELETE FROM wiki_resolutions WHERE key = ?", [(key,) for key in keys]
+            )
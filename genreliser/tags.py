@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterable
+
+from mutagen.easymp4 import EasyMP4
+from mutagen.flac import FLAC, VCFLACDict
+from mutagen.id3 import ID3, Frames, Frames_2_2, ID3NoHeaderError
+from mutagen.oggopus import OggOpus
+from mutagen.oggvorbis import OggVorbis
+
+Tags = dict[str, list[str]]  # see TAG_KEYS for keys
+TagReader = Callable[[Path], Tags]
+
+# keys each field is read from in Vorbis comments and EasyMP4, by preference
+TAG_KEYS = {
+    "title": ["title"],
+    "description": ["description", "comment"],
+    "genre": ["genre"],
+    "artist": ["artist"],
+    "album": ["album"],
+}
+# ...and the frames it's read from in ID3, as "<frame id>:<description>" for frames
+# with one (only those with that description, e.g. no COMM from an encoder, are read)
+ID3_FRAME_IDS = {
+    "title": ["TIT2"],
+    "description": ["TXXX:description", "COMM:"],
+    "genre": ["TCON"],
+    "artist": ["TPE1"],
+    "album": ["TALB"],
+}
+# ID3v2.2's frames for the same, which mutagen translates to the above
+ID3V22_FRAME_IDS = ["TT2", "TXX", "COM", "TCO", "TP1", "TAL"]
+
+FLAC_MAGIC = b"fLaC"
+FLAC_VORBIS_COMMENT = 4
+
+# files whose tags are kept, e.g. after being read ahead of processing the files
+TAG_CACHE_SIZE = 256
+
+SUFFIX_TAG_FUNCTIONS: dict[str, TagReader] = {}
+
+
+def register_tag_reader(*suffixes: str):
+    """registers the decorated function to read the tags of files with `suffixes`"""
+
+    def decorator(tag_reader: TagReader) -> TagReader:
+        for suffix in suffixes:
+            SUFFIX_TAG_FUNCTIONS[suffix.lower()] = tag_reader
+        return tag_reader
+
+    return decorator
+
+
+@lru_cache(maxsize=TAG_CACHE_SIZE)
+def get_tags(filepath: Path) -> Tags:
+    """the fields in TAG_KEYS that a file's tags have, as lists of strings"""
+    suffix = filepath.suffix.lower()
+    if (suffix_tag_function := SUFFIX_TAG_FUNCTIONS.get(suffix)) is None:
+        raise NotImplementedError(
+            f"{filepath.name}: suffix {filepath.suffix} not supported"
+            f" - must be in {list(SUFFIX_TAG_FUNCTIONS)}"
+        )
+    return suffix_tag_function(filepath)
+
+
+def get_fields(
+    get_values: Callable[[str], Iterable], tag_keys: dict[str, list[str]] = TAG_KEYS
+) -> Tags:
+    """each field from the first of its keys with `get_values(key)`, if any has"""
+    fields = {}
+    for field_name, keys in tag_keys.items():
+        for key in keys:
+            if values := [str(value) for value in get_values(key) if str(value)]:
+                fields[field_name] = values
+                break
+    return fields
+
+
+@register_tag_reader(".m4a")
+def read_mp4_tags(filepath: Path) -> Tags:
+    tags = EasyMP4(filepath)
+    return get_fields(lambda key: tags.get(key, []))
+
+
+@register_tag_reader(".mp3")
+def read_id3_tags(filepath: Path) -> Tags:
+    """reads only the ID3 tag (not the audio), parsing only the frames needed"""
+    known_frames = {
+        **{
+            id_: Frames[id_]
+            for keys in ID3_FRAME_IDS.values()
+            for id_ in (key.partition(":")[0] for key in keys)
+        },
+        **{id_: Frames_2_2[id_] for id_ in ID3V22_FRAME_IDS},
+    }
+    try:
+        # other frames (e.g. embedded artwork) are skipped over unparsed
+        tags = ID3(filepath, known_frames=known_frames)
+    except ID3NoHeaderError:
+        return {}
+
+    def get_values(key: str):
+        frame_id, has_desc, desc = key.partition(":")
+        frames = tags.getall(frame_id)
+        if has_desc:
+            frames = [frame for frame in frames if frame.desc.lower() == desc]
+        if frame_id == "TCON":
+            # resolves numeric ID3v1 genres to their names
+            return [genre for frame in frames for genre in frame.genres]
+        return [text for frame in frames for text in frame.text]
+
+    return get_fields(get_values, ID3_FRAME_IDS)
+
+
+@register_tag_reader(".flac")
+def read_flac_tags(filepath: Path) -> Tags:
+    """reads only the Vorbis comment block, seeking past others (e.g. pictures)"""
+    with open(filepath, "rb") as file:
+        if file.read(len(FLAC_MAGIC)) != FLAC_MAGIC:
+            # e.g. starts with an ID3 tag, which mutagen knows how to skip
+            tags = FLAC(filepath).tags or {}
+            return get_fields(lambda key: tags.get(key, []))
+        while len(block_header := file.read(4)) == 4:
+            block_type = block_header[0] & 0x7F
+            block_size = int.from_bytes(block_header[1:], "big")
+            if block_type == FLAC_VORBIS_COMMENT:
+                tags = VCFLACDict(file.read(block_size))
+                return get_fields(lambda key: tags.get(key, []))
+            if block_header[0] & 0x80:
+                break  # the last metadata block
+            file.seek(block_size, os.SEEK_CUR)
+    return {}
+
+
+@register_tag_reader(".opus")
+def read_opus_tags(filepath: Path) -> Tags:
+    tags = OggOpus(filepath).tags or {}
+    return get_fields(lambda key: tags.get(key, []))
+
+
+@register_tag_reader(".ogg")
+def read_vorbis_tags(filepath: Path) -> Tags:
+    tags = OggVorbis(filepath).tags or {}
+    return get_fields(lambda key: tags.get(key, []))
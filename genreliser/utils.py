@@ -1,8 +1,14 @@
 from __future__ import annotations
 
+import functools
+import hashlib
 import logging
 import re
+import sqlite3
+import threading
 import unicodedata
+from contextlib import contextmanager
+from pathlib import Path
 
 import unidecode
 from utils_python import dump_data
@@ -10,6 +16,86 @@ from yt_dlp.utils import sanitize_filename
 
 LOGGER = logging.getLogger("genreliser")
 
+_NOT_FOUND = object()
+
+
+class cached_property(functools.cached_property):
+    """
+    functools.cached_property without the per-attribute lock that python<3.12 holds
+    across *all* instances, which would serialise every file's network lookups
+    """
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        cache = instance.__dict__
+        value = cache.get(self.attrname, _NOT_FOUND)
+        if value is _NOT_FOUND:
+            value = self.func(instance)
+            cache[self.attrname] = value
+        return value
+
+
+class ThreadLogPrefixFilter(logging.Filter):
+    """
+    Prefixes records with the prefix set for the current thread,
+    so concurrently-processed files keep their own log prefix
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.local = threading.local()
+
+    @property
+    def prefix(self) -> str:
+        return getattr(self.local, "prefix", "")
+
+    @prefix.setter
+    def prefix(self, prefix: str):
+        self.local.prefix = prefix
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if prefix := self.prefix:
+            record.msg = f"{prefix}{record.msg}"
+        return True
+
+
+_thread_log_prefix_filters: dict[str, ThreadLogPrefixFilter] = {}
+_thread_log_prefix_filters_lock = threading.Lock()
+
+
+def get_thread_log_prefix_filter(logger: logging.Logger) -> ThreadLogPrefixFilter:
+    with _thread_log_prefix_filters_lock:
+        if (prefix_filter := _thread_log_prefix_filters.get(logger.name)) is None:
+            prefix_filter = _thread_log_prefix_filters[
+                logger.name
+            ] = ThreadLogPrefixFilter()
+            logger.addFilter(prefix_filter)
+    return prefix_filter
+
+
+@contextmanager
+def thread_log_prefix(logger: logging.Logger, msg_prefix: str):
+    """thread-safe equivalent of utils_python.logPrefixFilter"""
+    prefix_filter = get_thread_log_prefix_filter(logger)
+    prefix_old, prefix_filter.prefix = prefix_filter.prefix, msg_prefix
+    try:
+        yield
+    finally:
+        prefix_filter.prefix = prefix_old
+
+
+def with_thread_log_prefix(logger: logging.Logger, function):
+    """wraps `function` to log with the calling thread's prefix, wherever it's run"""
+    prefix = get_thread_log_prefix_filter(logger).prefix
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with thread_log_prefix(logger, prefix):
+            return function(*args, **kwargs)
+
+    return wrapper
+
 
 def char_filter(string):
     # https://stackoverflow.com/a/46041974
@@ -68,3 +154,23 @@ def combine_listdicts(*listdicts: dict[str, list | str | dict]):
                 if v is not None:
                     combined[k] = v
     return combined
+
+
+def connect_sqlite(path: Path) -> sqlite3.Connection:
+    """
+    Opens (creating if necessary) a database shared between threads, in autocommit mode;
+    callers are expected to serialise access themselves
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+def hash_file(path: Path, chunk_size: int = 2**20) -> str:
+    file_hash = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
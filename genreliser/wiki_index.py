@@ -0,0 +1,501 @@
+from __future__ import annotations
+
+import bz2
+import gzip
+import json
+import logging
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from tqdm import tqdm
+from utils_python import deduplicate
+
+from genreliser.fandom_ import (
+    QUERY_BATCH_SIZE,
+    WikiClient,
+    get_latest_revisions,
+    iter_query_responses,
+    merge_page_data,
+)
+from genreliser.utils import connect_sqlite
+
+LOGGER = logging.getLogger("genreliser")
+
+DEFAULT_WIKI_INDEX_PATH = Path("data/wiki_index.sqlite")
+SONGS_CATEGORY = "Songs"
+
+PATTERN_TITLE_DISAMBIGUATOR = r"^(?P<title>.+?) \((?P<disambiguator>[^()]+)\)$"
+PATTERN_WIKILINK = r"\[\[(?P<target>[^\]|]+)(?:\|(?P<label>[^\]]*))?\]\]"
+PATTERN_CATEGORY = r"\[\[\s*Category\s*:\s*(?P<category>[^\]|]+?)\s*(?:\|[^\]]*)?\]\]"
+PATTERN_MARKUP = r"'{2,}|<[^>]+>|\{\{[^}]*\}\}"
+PATTERN_LIST_SEPARATOR = r"\s*(?:<br\s*/?>|\n|,)\s*"
+
+IndexRecord = dict  # see `WikiIndex.add_pages` for keys
+
+
+def normalise_title(title: str) -> str:
+    return " ".join(title.replace('"', "").casefold().split())
+
+
+def split_top_level(text: str, sep: str = "|") -> list[str]:
+    """splits `text` on `sep`, ignoring any inside links or templates"""
+    parts = []
+    depth = start = i = 0
+    while i < len(text):
+        pair = text[i : i + 2]
+        if pair in {"{{", "[["}:
+            depth += 1
+            i += 2
+        elif pair in {"}}", "]]"}:
+            depth -= 1
+            i += 2
+        else:
+            if text[i] == sep and depth == 0:
+                parts.append(text[start:i])
+                start = i + 1
+            i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def iter_templates(wikitext: str) -> Iterator[tuple[str, dict[str, str]]]:
+    """yields the name and named parameters of each top-level template"""
+    i = 0
+    while (start := wikitext.find("{{", i)) != -1:
+        depth = 0
+        end = start
+        while end < len(wikitext):
+            pair = wikitext[end : end + 2]
+            if pair == "{{":
+                depth += 1
+                end += 2
+            elif pair == "}}":
+                depth -= 1
+                end += 2
+                if depth == 0:
+                    break
+            else:
+                end += 1
+        name, *param_strs = split_top_level(wikitext[start + 2 : end - 2])
+        params = {}
+        for param_str in param_strs:
+            key, sep, value = param_str.partition("=")
+            if sep:
+                params[key.strip()] = value.strip()
+        yield name.strip(), params
+        i = end
+
+
+def strip_markup(wikitext: str) -> str:
+    wikitext = re.sub(
+        PATTERN_WIKILINK,
+        lambda match: match.group("label") or match.group("target"),
+        wikitext,
+    )
+    return re.sub(PATTERN_MARKUP, "", wikitext).strip()
+
+
+def get_list_from_wikitext(wikitext: str) -> list[str]:
+    # prefer link labels, as shown on the rendered page
+    if links := list(re.finditer(PATTERN_WIKILINK, wikitext)):
+        values = [match.group("label") or match.group("target") for match in links]
+    else:
+        values = re.split(PATTERN_LIST_SEPARATOR, wikitext)
+    return deduplicate(
+        [value for value in map(strip_markup, values) if value and value != "|"]
+    )
+
+
+def parse_song_page(
+    title: str,
+    wikitext: str,
+    pageid: int,
+    revid: Optional[int],
+    url: str,
+    aliases: Iterable[str] = (),
+    assume_song: bool = False,
+) -> IndexRecord | None:
+    """extracts an index record from a song page's wikitext, or None if not a song"""
+    categories = [
+        category.strip() for category in re.findall(PATTERN_CATEGORY, wikitext)
+    ]
+    templates = list(iter_templates(wikitext))
+    is_song = (
+        assume_song
+        or SONGS_CATEGORY in categories
+        or any("song" in name.casefold() for name, _params in templates)
+    )
+    if not is_song:
+        return None
+
+    name = None
+    genres: list[str] = []
+    for _template_name, params in templates:
+        for key, value in params.items():
+            if key.casefold() == "name" and name is None:
+                name = strip_markup(value) or None
+            elif "genre" in key.casefold():
+                genres.extend(get_list_from_wikitext(value))
+
+    if match := re.match(PATTERN_TITLE_DISAMBIGUATOR, title):
+        title_base, disambiguator = match.group("title", "disambiguator")
+    else:
+        title_base, disambiguator = title, None
+
+    return {
+        "pageid": pageid,
+        "title": title,
+        "name": name or title_base,
+        "disambiguator": disambiguator,
+        "url": url,
+        "genres": deduplicate(genres),
+        "aliases": deduplicate([title_base, *([name] if name else []), *aliases]),
+        "revid": revid,
+    }
+
+
+class WikiIndex:
+    """
+    Local SQLite index of a wiki's song pages, looked up by normalised title or alias
+    """
+
+    def __init__(self, path: Path = DEFAULT_WIKI_INDEX_PATH) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = connect_sqlite(self.path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                pageid INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                name TEXT,
+                disambiguator TEXT,
+                url TEXT NOT NULL,
+                genres TEXT NOT NULL,
+                aliases TEXT NOT NULL,
+                revid INTEGER,
+                indexed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS aliases (
+                alias TEXT NOT NULL,
+                pageid INTEGER NOT NULL REFERENCES pages (pageid),
+                PRIMARY KEY (alias, pageid)
+            );
+            """
+        )
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.path}'>"
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    @staticmethod
+    def _row_to_record(row) -> IndexRecord:
+        pageid, title, name, disambiguator, url, genres, aliases, revid, _ = row
+        return {
+            "pageid": pageid,
+            "title": title,
+            "name": name,
+            "disambiguator": disambiguator,
+            "url": url,
+            "genres": json.loads(genres),
+            "aliases": json.loads(aliases),
+            "revid": revid,
+        }
+
+    def add_pages(self, records: Iterable[IndexRecord]) -> int:
+        now = time.time()
+        count = 0
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            for record in records:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        record["pageid"],
+                        record["title"],
+                        record["name"],
+                        record["disambiguator"],
+                        record["url"],
+                        json.dumps(record["genres"]),
+                        json.dumps(record["aliases"]),
+                        record["revid"],
+                        now,
+                    ),
+                )
+                self.connection.execute(
+                    "DELETE FROM aliases WHERE pageid = ?", (record["pageid"],)
+                )
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO aliases VALUES (?, ?)",
+                    [
+                        (normalise_title(alias), record["pageid"])
+                        for alias in [record["title"], *record["aliases"]]
+                    ],
+                )
+                count += 1
+        return count
+
+    def remove_pages(self, pageids: Iterable[int]) -> int:
+        pageids = [(pageid,) for pageid in pageids]
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("DELETE FROM aliases WHERE pageid = ?", pageids)
+            self.connection.executemany("DELETE FROM pages WHERE pageid = ?", pageids)
+        return len(pageids)
+
+    def get_revids(self) -> dict[int, Optional[int]]:
+        with self.lock:
+            rows = self.connection.execute("SELECT pageid, revid FROM pages").fetchall()
+        return dict(rows)
+
+    def records(self) -> list[IndexRecord]:
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM pages").fetchall()
+        return [self._row_to_record(row) for row in rows]
+
+    def get(self, pageid: int) -> IndexRecord | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM pages WHERE pageid = ?", (pageid,)
+            ).fetchone()
+        return None if row is None else self._row_to_record(row)
+
+    def lookup(
+        self, title: str, disambiguators: Iterable[str] = ()
+    ) -> IndexRecord | None:
+        """
+        Returns the page for `title` if the index can decide unambiguously,
+        using `disambiguators` (e.g. the artist) to choose between same-titled songs
+        """
+        disambiguators_normalised = {normalise_title(d) for d in disambiguators}
+        aliases = [
+            normalise_title(title),
+            *[f"{normalise_title(title)} ({d})" for d in disambiguators_normalised],
+        ]
+        with self.lock:
+            rows = self.connection.execute(
+                f"""
+                SELECT DISTINCT pages.* FROM aliases JOIN pages USING (pageid)
+                WHERE alias IN ({", ".join("?" * len(aliases))})
+                """,
+                aliases,
+            ).fetchall()
+        records = [self._row_to_record(row) for row in rows]
+        matches = [
+            record
+            for record in records
+            if record["disambiguator"] is None
+            or normalise_title(record["disambiguator"]) in disambiguators_normalised
+        ]
+        if len(matches) > 1:
+            # prefer the disambiguated page that matched, over a generic one
+            matches = [record for record in matches if record["disambiguator"]]
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+
+def open_dump(dump_path: Path):
+    if dump_path.suffix == ".gz":
+        return gzip.open(dump_path, "rb")
+    if dump_path.suffix == ".bz2":
+        return bz2.open(dump_path, "rb")
+    return open(dump_path, "rb")
+
+
+def iter_records_from_dump(
+    dump_path: Path, client: WikiClient
+) -> Iterator[IndexRecord]:
+    """yields a record for each song page in a MediaWiki XML dump"""
+    redirects: dict[str, list[str]] = {}
+    pages = []
+    with open_dump(dump_path) as dump_file:
+        for _event, elem in ET.iterparse(dump_file):
+            if not elem.tag.endswith("}page"):
+                continue
+            if elem.findtext("{*}ns") == "0":
+                title = elem.findtext("{*}title")
+                if (redirect := elem.find("{*}redirect")) is not None:
+                    redirects.setdefault(redirect.get("title"), []).append(title)
+                else:
+                    pages.append(
+                        (
+                            title,
+                            elem.findtext("{*}revision/{*}text") or "",
+                            int(elem.findtext("{*}id")),
+                            int(elem.findtext("{*}revision/{*}id")),
+                        )
+                    )
+            elem.clear()
+
+    # aliases come from redirects, which may appear after their target in the dump
+    for title, wikitext, pageid, revid in pages:
+        record = parse_song_page(
+            title,
+            wikitext,
+            pageid,
+            revid,
+            client.get_page_url(title),
+            aliases=redirects.get(title, []),
+        )
+        if record is not None:
+            yield record
+
+
+def get_revision_content(revision: dict) -> str:
+    # `slots` is only present with rvslots, on MediaWiki >= 1.32
+    if "slots" in revision:
+        return revision["slots"]["main"].get("*", "")
+    return revision.get("*", "")
+
+
+def iter_records_from_pages_query(
+    query_params: dict, client: WikiClient, assume_song: bool
+) -> Iterator[IndexRecord]:
+    """yields a record for each page returned by a query with revision content"""
+    query_params = {
+        **query_params,
+        "action": "query",
+        "prop": "revisions|info|redirects",
+        "rvprop": "ids|content",
+        "rvslots": "main",
+        "inprop": "url",
+        "rdlimit": "max",
+    }
+    pages: dict[int, dict] = {}
+    for response in iter_query_responses(client, query_params):
+        for page in response.get("query", {}).get("pages", {}).values():
+            merge_page_data(pages.setdefault(page["pageid"], {}), page)
+        # a batch of pages can span several continuations (e.g. for many redirects)
+        if "batchcomplete" not in response:
+            continue
+        for page in pages.values():
+            if not (revisions := page.get("revisions")):
+                continue
+            record = parse_song_page(
+                page["title"],
+                get_revision_content(revisions[0]),
+                page["pageid"],
+                revisions[0].get("revid"),
+                client.get_page_url(page["title"]),
+                aliases=[redirect["title"] for redirect in page.get("redirects", [])],
+                assume_song=assume_song,
+            )
+            if record is not None:
+                yield record
+        pages = {}
+
+
+def iter_records_from_crawl(client: WikiClient) -> Iterator[IndexRecord]:
+    """yields a record for each page in the wiki's Songs category"""
+    yield from iter_records_from_pages_query(
+        {
+            "generator": "categorymembers",
+            "gcmtitle": f"Category:{SONGS_CATEGORY}",
+            "gcmnamespace": 0,
+            "gcmlimit": 50,  # the maximum when requesting revision content
+        },
+        client,
+        assume_song=True,
+    )
+
+
+def iter_records_from_release(
+    client: WikiClient, release_title: str
+) -> Iterator[IndexRecord]:
+    """
+    yields a record for each song page linked from a release's (e.g. an album's)
+    page, such as those in its tracklist
+    """
+    yield from iter_records_from_pages_query(
+        {
+            "generator": "links",
+            "titles": release_title,
+            "gplnamespace": 0,
+            "gpllimit": 50,  # the maximum when requesting revision content
+            "redirects": "",
+        },
+        client,
+        assume_song=False,
+    )
+
+
+def build_wiki_index(
+    index: WikiIndex,
+    client: WikiClient,
+    dump_path: Optional[Path] = None,
+    batch_size: int = 500,
+) -> int:
+    if dump_path is None:
+        LOGGER.info("crawling category '%s' of %s", SONGS_CATEGORY, client)
+        records = iter_records_from_crawl(client)
+    else:
+        LOGGER.info("reading dump '%s'", dump_path)
+        records = iter_records_from_dump(dump_path, client)
+
+    count = 0
+    batch = []
+    for record in tqdm(records, unit="page"):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            count += index.add_pages(batch)
+            batch = []
+    count += index.add_pages(batch)
+    LOGGER.info("indexed %s pages into '%s'", count, index.path)
+    return count
+
+
+def refresh_wiki_index(
+    index: WikiIndex, client: WikiClient, batch_size: int = 500
+) -> tuple[int, int]:
+    """
+    Re-indexes only the pages whose revision has changed since they were indexed,
+    and removes deleted pages, returning how many were updated and removed.
+    Pages added to the wiki since need a full `build_wiki_index`.
+    """
+    revids = index.get_revids()
+    LOGGER.info("checking %s indexed pages for new revisions", len(revids))
+    latest_revisions = get_latest_revisions(client, revids)
+    pageids_removed = [pageid for pageid in revids if pageid not in latest_revisions]
+    revids_changed = [
+        revid
+        for pageid, (revid, _title) in latest_revisions.items()
+        if revid != revids[pageid]
+    ]
+    LOGGER.info(
+        "%s pages changed and %s removed", len(revids_changed), len(pageids_removed)
+    )
+
+    updated = 0
+    pageids_updated = set()
+    batch = []
+    for i in tqdm(range(0, len(revids_changed), QUERY_BATCH_SIZE), unit="batch"):
+        # by revision id, so cached responses are never of an older revision
+        for record in iter_records_from_pages_query(
+            {"revids": "|".join(map(str, revids_changed[i : i + QUERY_BATCH_SIZE]))},
+            client,
+            assume_song=True,
+        ):
+            batch.append(record)
+            pageids_updated.add(record["pageid"])
+            if len(batch) >= batch_size:
+                updated += index.add_pages(batch)
+                batch = []
+    updated += index.add_pages(batch)
+
+    # changed pages that no longer parse as songs are removed too
+    pageids_removed.extend(
+        pageid
+        for pageid, (revid, _title) in latest_revisions.items()
+        if revid != revids[pageid] and pageid not in pageids_updated
+    )
+    removed = index.remove_pages(pageids_removed)
+    LOGGER.info("updated %s and removed %s pages in '%s'", updated, removed, index.path)
+    return updated, removed